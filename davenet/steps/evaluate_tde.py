@@ -10,6 +10,7 @@ import nltk
 from nltk.stem import WordNetLemmatizer
 from nltk.corpus import stopwords
 import time
+import sys
 '''
 from tde.readers.gold_reader import *
 from tde.readers.disc_reader import *
@@ -19,6 +20,8 @@ from tde.measures.boundary import *
 from tde.measures.ned import *
 from tde.measures.token_type import *
 '''
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../utils'))
+from alignment_io import read_alignments, count_alignments, find_alignment_file
 
 PUNCT = [',', '\'', '\"', '/', '?', '>', '<', '#', '%', '&', '*', ':', ';', '!', '.']
 STOP = stopwords.words('english') + ['er', 'oh', 'ah', 'uh', 'um', 'ha']
@@ -250,11 +253,10 @@ def speechcoco_extract_pred_units(pred_alignment_file,
                                   include_null=False):
   begin_time = time.time()
   print('Begin extracting predicted units for speechcoco...')
-  with open(alignment_file, 'r') as align_f,\
-       open('{}_discovered_words.class'.format(out_file), 'w') as pred_f,\
+  with open('{}_discovered_words.class'.format(out_file), 'w') as pred_f,\
        open('{}_discovered_links.txt'.format(out_file), 'w') as pred_link_f:
     # Create predicted clusters by selecting word units that align to the concept clusters
-    alignments = json.load(align_f)
+    alignments = read_alignments(alignment_file)
     gold_boxes, img_ids = load_boxes(gold_box_file, dataset='speechcoco')
     pred_boxes = json.load(open(pred_box_file, 'r'))
     gold_boxes = gold_boxes[::ds_ratio]
@@ -369,8 +371,7 @@ def mscoco_extract_pred_units(pred_alignment_file,
   with open(caption_file, 'r') as capt_f:
     captions = [line.strip().split() for line in capt_f]
   
-  with open(pred_alignment_file, 'r') as pred_align_f:
-    alignments = json.load(pred_align_f)
+  alignments = read_alignments(pred_alignment_file)
 
   gold_boxes, img_ids = load_boxes(gold_box_file, dataset='speechcoco')
   pred_boxes = json.load(open(pred_box_file, 'r'))
@@ -485,13 +486,12 @@ def flickr_extract_pred_units(pred_alignment_file,
                               include_null=True):
   print('Start extracting predicted units for flickr ...')
   begin_time = time.time()
-  with open(pred_alignment_file, 'r') as pred_align_f,\
-       open(ignore_ids_file, 'r') as ignore_f,\
+  with open(ignore_ids_file, 'r') as ignore_f,\
        open('{}_discovered_words.class'.format(out_file), 'w') as pred_f,\
        open('{}_discovered_links.txt'.format(out_file), 'w') as pred_link_f:
 
     ignore_ids = ['_'.join(line.split('_')[:-1]) for line in ignore_f]
-    alignments = json.load(pred_align_f)
+    alignments = list(read_alignments(pred_alignment_file))
 
     gold_boxes, img_ids = load_boxes(gold_box_file, pron_file, top_word_file)
     pred_boxes, _ = load_boxes(pred_box_file, box_type='pred')
@@ -852,18 +852,18 @@ if __name__ == '__main__':
 
 
   if args.dataset == 'speechcoco':
-    alignment_file = '{}/alignment.json'.format(args.exp_dir)
+    alignment_file = find_alignment_file('{}/alignment'.format(args.exp_dir))
     data_root = '/ws/ifp-53_2/hasegawa/lwang114/data/mscoco/'
     caption_file = '{}/train2014/mscoco_train_text_captions.txt'.format(data_root)
     segment_file = '{}/train2014/mscoco_train_word_segments.txt'.format(data_root) if args.dataset == 'speechcoco' else '{}/train2014/mscoco_train_word_phone_segments.txt'.format(data_root) 
     gold_box_file = '{}/train2014/mscoco_train_bboxes.txt'.format(data_root) 
     pred_box_file = '{}/train2014/mscoco_train_bboxes_rcnn.json'.format(data_root) 
 
-    alignments = json.load(open(alignment_file, 'r'))
+    n_alignments = count_alignments(alignment_file)
     ds_ratio = 1 
-    if 30000 < len(alignments) < 50000: # XXX
+    if 30000 < n_alignments < 50000: # XXX
         ds_ratio = 2
-    elif len(alignments) < 30000:
+    elif n_alignments < 30000:
         ds_ratio = 3
 
     ignore_ids = speechcoco_extract_gold_units(segment_file, 
@@ -891,7 +891,7 @@ if __name__ == '__main__':
                                    out_file='{}/tde_results'.format(args.exp_dir))
   elif args.dataset == 'flickr':
     args.exp_dir = '/ws/ifp-53_2/hasegawa/lwang114/fall2020/exp/cont_mixture_aligner_flickr30k_phone_rcnn_10_1_2020' 
-    alignment_file = '{}/alignment.json'.format(args.exp_dir)
+    alignment_file = find_alignment_file('{}/alignment'.format(args.exp_dir))
     data_root = '/ws/ifp-53_2/hasegawa/lwang114/data/flickr30k/'
     text_caption_file = '{}/flickr30k_text_captions_filtered.txt'.format(data_root)
     segmented_caption_file = '{}/flickr30k_phone_captions_segmented.txt'.format(data_root)
@@ -926,7 +926,7 @@ if __name__ == '__main__':
                                      mode = 'iou',
                                      out_file='{}/tde_results_iou'.format(args.exp_dir))
   elif args.dataset.split('_')[0] == 'mscoco':
-    alignment_file = '{}/alignment.json'.format(args.exp_dir)
+    alignment_file = find_alignment_file('{}/alignment'.format(args.exp_dir))
     data_root = '/ws/ifp-53_2/hasegawa/lwang114/data/mscoco/'
     caption_file = '{}/train2014/mscoco_train_text_captions.txt'.format(data_root)
     segment_file = '{}/train2014/mscoco_train_word_phone_segments.txt'.format(data_root)
@@ -937,11 +937,11 @@ if __name__ == '__main__':
     gold_box_file = '{}/train2014/mscoco_train_bboxes.txt'.format(data_root) 
     pred_box_file = '{}/train2014/mscoco_train_bboxes_rcnn.json'.format(data_root) 
 
-    alignments = json.load(open(alignment_file, 'r'))
+    n_alignments = count_alignments(alignment_file)
     ds_ratio = 1 
-    if 30000 < len(alignments) < 50000: # XXX
+    if 30000 < n_alignments < 50000: # XXX
         ds_ratio = 2
-    elif len(alignments) < 30000:
+    elif n_alignments < 30000:
         ds_ratio = 3
 
     ignore_ids = mscoco_extract_gold_units(segment_file, 
@@ -5,9 +5,12 @@ import torch.nn as nn
 import numpy as np
 import pickle
 import json
+import os
+import sys
 from .util import *
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../utils'))
+from alignment_io import AlignmentWriter
 import pdb
-import os
 
 def train_attention(audio_model, image_model, attention_model, train_loader, test_loader, args):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -433,7 +436,7 @@ def align_attention(audio_model, image_model, val_loader, args):
     A_embeddings = [] 
     frame_counts = []
     region_counts = []
-    alignments = []
+    writer = AlignmentWriter('{}/{}'.format(args.exp_dir, args.alignment_scores))
     with torch.no_grad():
         for i, (audio_input, image_input, nphones, nregions) in enumerate(val_loader):
             image_input = image_input.to(device)
@@ -473,18 +476,17 @@ def align_attention(audio_model, image_model, val_loader, args):
               # if (i*B+i_b) % 3 != 0: # XXX
               #   continue
               M = computeMatchmap(image_output[i_b], audio_output[i_b, :, :max(int(n_segments[i_b]), 1)])
-              alignment = np.argmax(M.squeeze(1).numpy(), axis=1).tolist() # XXX
+              alignment = np.argmax(M.squeeze(1).numpy(), axis=1) # XXX
               cur_idx = selected_indices[i*B+i_b]
               align_info = {
                 'index': cur_idx,
                 'alignment': alignment,
                 'image_concepts': [0]*len(alignment),
-                'align_probs': M.squeeze(1).numpy().tolist()
+                'align_probs': M.squeeze(1).numpy()
                 }
-              alignments.append(align_info)
+              writer.write(align_info)
             print('Process {} batches after {}s'.format(i, time.time()-end))
-    with open('{}/{}'.format(args.exp_dir, args.alignment_scores), 'w') as f:
-      json.dump(alignments, f, indent=4, sort_keys=True)
+    writer.close()
 
 
 def validate_vector(audio_model, image_model, val_loader, args):
@@ -6,7 +6,10 @@ import torch.nn as nn
 from torch.autograd import Variable
 import pdb
 import os
+import sys
 import json
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../utils'))
+from retrieval_metrics import matching_ranks, rank_metrics
 
 def calc_recalls(image_outputs, audio_outputs, args, nframes, simtype='MISA', nregions=None):
     """
@@ -39,51 +42,14 @@ def calc_recalls(image_outputs, audio_outputs, args, nframes, simtype='MISA', nr
     # pdb.set_trace()
     A2I_scores, A2I_ind = S.topk(10, 0)
     I2A_scores, I2A_ind = S.topk(10, 1)
-    A_r1 = AverageMeter()
-    A_r5 = AverageMeter()
-    A_r10 = AverageMeter()
-    I_r1 = AverageMeter()
-    I_r5 = AverageMeter()
-    I_r10 = AverageMeter()
-    for i in range(n):
-        A_foundind = -1
-        I_foundind = -1
-        for ind in range(10):
-            if A2I_ind[ind, i] == i:
-                I_foundind = ind
-            if I2A_ind[i, ind] == i:
-                A_foundind = ind
-        # do r1s
-        if A_foundind == 0:
-            A_r1.update(1)
-        else:
-            A_r1.update(0)
-        if I_foundind == 0:
-            I_r1.update(1)
-        else:
-            I_r1.update(0)
-        # do r5s
-        if A_foundind >= 0 and A_foundind < 5:
-            A_r5.update(1)
-        else:
-            A_r5.update(0)
-        if I_foundind >= 0 and I_foundind < 5:
-            I_r5.update(1)
-        else:
-            I_r5.update(0)
-        # do r10s
-        if A_foundind >= 0 and A_foundind < 10:
-            A_r10.update(1)
-        else:
-            A_r10.update(0)
-        if I_foundind >= 0 and I_foundind < 10:
-            I_r10.update(1)
-        else:
-            I_r10.update(0)
-
-    recalls = {'A_r1':A_r1.avg, 'A_r5':A_r5.avg, 'A_r10':A_r10.avg,
-                'I_r1':I_r1.avg, 'I_r5':I_r5.avg, 'I_r10':I_r10.avg}
-                #'A_meanR':A_meanR.avg, 'I_meanR':I_meanR.avg}
+    S_np = S.detach().cpu().numpy()
+    A_metrics = rank_metrics(matching_ranks(S_np, axis=1))
+    I_metrics = rank_metrics(matching_ranks(S_np, axis=0))
+    recalls = {'A_r1':A_metrics['R@1'], 'A_r5':A_metrics['R@5'], 'A_r10':A_metrics['R@10'],
+                'I_r1':I_metrics['R@1'], 'I_r5':I_metrics['R@5'], 'I_r10':I_metrics['R@10'],
+                'A_medR':A_metrics['median_rank'], 'I_medR':I_metrics['median_rank'],
+                'A_meanR':A_metrics['mean_rank'], 'I_meanR':I_metrics['mean_rank'],
+                'A_mAP':A_metrics['mAP'], 'I_mAP':I_metrics['mAP']}
     save_results_A2I = os.path.join(args.exp_dir,'A2I.text')
     save_results_I2A = os.path.join(args.exp_dir,'I2A.text')
     np.savetxt(save_results_A2I,A2I_ind.transpose(1,0).int().numpy(),fmt='%d')
@@ -227,32 +193,55 @@ def DAMSM_loss(image_outputs, audio_outputs, nframes, margin=0.001, simtype='MIS
     loss = nn.CrossEntropyLoss()(scores0, labels) + nn.CrossEntropyLoss()(scores1, labels)
     return loss
 
-def compute_matchmap_similarity_matrix(image_outputs, audio_outputs, nframes, simtype='MISA', nregions=None):
+def compute_matchmap_similarity_matrix(image_outputs, audio_outputs, nframes, simtype='MISA', nregions=None, max_elements=2**26):
     """
     Assumes image_outputs is a (batchsize, embedding_dim, rows, height) tensor
     Assumes audio_outputs is a (batchsize, embedding_dim, 1, time) tensor
     Returns similarity matrix S where images are rows and audios are along the columns
+
+    The matchmaps of all the (image, audio) pairs are computed by one einsum 
+    over the padded outputs, for blocks of images of at most max_elements 
+    matchmap entries, and pooled as in matchmapSim with the frames beyond 
+    nframes and the rows beyond nregions masked out. SISA, which is linear
+    in the matchmaps, contracts the masked outputs without forming them
     """
     assert(image_outputs.dim() == 4)
     assert(audio_outputs.dim() == 3)
-    n = image_outputs.size(0)
-    S = torch.zeros(n, n, device=image_outputs.device)
-    for image_idx in range(n):
-            for audio_idx in range(n):
-                nF = max(1, nframes[audio_idx])
-                if len(nregions):
-                  nR = max(1, nregions[image_idx])
-                  S[image_idx, audio_idx] = matchmapSim(computeMatchmap(image_outputs[image_idx][:, 0:nR], audio_outputs[audio_idx][:, 0:nF]), simtype)
-                else:
-                  S[image_idx, audio_idx] = matchmapSim(computeMatchmap(image_outputs[image_idx][:, 0:nR], audio_outputs[audio_idx][:, 0:nF]), simtype)
-                '''
-                if image_idx == 0 and audio_idx == 0:
-                    Mmap = computeMatchmap(image_outputs[image_idx][:, 0:nR], audio_outputs[audio_idx][:, 0:nF]).mean(-1).cpu().detach().numpy()
-                    print('Mmap.shape: {}'.format(Mmap.shape))
-                    with open('matchmap.json', 'w') as f:
-                        json.dump(Mmap.tolist(), f)
-                '''
-    return S
+    n, D, H, W = image_outputs.size()
+    T = audio_outputs.size(2)
+    device = image_outputs.device
+    nF = torch.as_tensor(nframes, device=device).long().view(-1).clamp(1, T)
+    if nregions is not None and len(nregions):
+        nR = torch.as_tensor(nregions, device=device).long().view(-1).clamp(1, H)
+    else:
+        nR = torch.full((n,), H, device=device).long()
+    # Padding masks, 1 for the frames and rows to leave out
+    frame_pad = (torch.arange(T, device=device).long().unsqueeze(0) >= nF.unsqueeze(1)).view(1, n, 1, 1, T)
+    region_pad = (torch.arange(H, device=device).long().unsqueeze(0) >= nR.unsqueeze(1)).view(n, 1, H, 1, 1)
+
+    if simtype == 'SISA':
+        # The mean of a matchmap is the dot product of the sums of the image and audio outputs
+        I_sum = image_outputs.masked_fill(region_pad.view(n, 1, H, 1), 0.).sum(3).sum(2)
+        A_sum = audio_outputs.masked_fill(frame_pad.view(n, 1, T), 0.).sum(2)
+        return torch.einsum('id,jd->ij', [I_sum, A_sum]) / (nR.to(I_sum.dtype).view(-1, 1) * W * nF.to(I_sum.dtype).view(1, -1))
+
+    S = []
+    block_size = max(1, max_elements // max(n * H * W * T, 1))
+    for start in range(0, n, block_size):
+        M = torch.einsum('idhw,jdt->ijhwt', [image_outputs[start:start+block_size], audio_outputs])
+        M_region_pad = region_pad[start:start+block_size]
+        if simtype == 'MISA':
+            # Every column is valid, so the max over W is taken before masking the rows
+            M_maxW, _ = M.max(3)
+            M_maxHW, _ = M_maxW.masked_fill(M_region_pad.view(-1, 1, H, 1), float('-inf')).max(2)
+            S.append(M_maxHW.masked_fill(frame_pad.view(1, n, T), 0.).sum(2) / nF.to(M.dtype).view(1, -1))
+        elif simtype == 'SIMA':
+            M_maxT, _ = M.masked_fill(frame_pad, float('-inf')).max(4)
+            M_maxT = M_maxT.masked_fill(M_region_pad.view(-1, 1, H, 1), 0.)
+            S.append(M_maxT.sum(3).sum(2) / (nR[start:start+block_size].to(M.dtype).view(-1, 1) * W))
+        else:
+            raise ValueError
+    return torch.cat(S, 0)
 
 def compute_attentive_matchmap_similarity_matrix(image_outputs, audio_outputs, nframes, simtype='ASISA', nregions=None):
     """
@@ -7,20 +7,26 @@ class NegativeSquare(nn.Module):
     self.codebook = nn.Parameter(codebook, requires_grad=codebook.requires_grad)
     self.precision = nn.Parameter(precision * torch.ones((1,)), requires_grad=False) # TODO Make this trainable                                                                                            
 
-  def forward(self, x, compute_softmax=False):
-    """                                                                                                                                                                                                    
-    Args:                                                                                                                                                                                                  
-        x: B x T x D array of acoustic features                                                                                                                                                                                                                                                                                                                                                                       
-    Returns:                                                                                                                                                                                                       score: B x T x K array of gaussian log posterior probabilities                                                                                                                                     
-             [[[precision*(x[t] - mu[c[t]])**2 for k in range(K)] for t in range(T)] for b in range(B)]                                                                                                    
+  def forward(self, x, compute_softmax=False, chunk_size=256):
+    """
+    Args:
+        x: B x T x D array of acoustic features
+        chunk_size: number of frames whose B x chunk_size x K scores are computed at a time
+    Returns:
+        score: B x T x K array of gaussian log posterior probabilities
+             [[[-precision*||x[b, t] - mu[k]||^2 for k in range(K)] for t in range(T)] for b in range(B)],
+             computed as -precision*(||x||^2 - 2 x mu^T + ||mu||^2) with one matrix product per chunk
     """
-    # score1 = -(x.unsqueeze(-2) - self.codebook).pow(2).sum(-1)
-    # score1 = score1 * self.precision
-    # return self.precision * score
     B = x.size(0)
     T = x.size(1)
-    score = torch.stack([torch.stack([-self.precision * torch.sum((x[b, t] - self.codebook)**2, dim=1) for t in range(T)]) for b in range(B)])
+    K = self.codebook.size(0)
+    codebook_sq_norms = self.codebook.pow(2).sum(-1)
+    scores = []
+    for t in range(0, T, chunk_size):
+      x_chunk = x[:, t:t+chunk_size]
+      sq_dists = x_chunk.pow(2).sum(-1, keepdim=True) - 2 * torch.matmul(x_chunk, self.codebook.t()) + codebook_sq_norms
+      scores.append(-self.precision * sq_dists.clamp(min=0))
+    score = torch.cat(scores, dim=1) if len(scores) > 0 else x.new_zeros((B, 0, K))
     if compute_softmax:
       score = score.softmax(-1)
     return score
-    
@@ -0,0 +1,160 @@
+import numpy as np
+import logging
+import os
+import tempfile
+from aligner_utils import RaggedArray, is_discrete
+
+logger = logging.getLogger(__name__)
+
+class AlignerDataset(object):
+  """
+  (source, target) training pairs of an aligner, read on demand from feature
+  stores instead of being held as lists. The i-th example is made of the
+  region features src_store[src_ids[i]], truncated to their first max_src_len
+  rows, and the target sentence trg_store[trg_ids[i]], e.g., word ids or
+  frame posteriors. The stores can be memory-mapped (see load_feature_store()),
+  so that only the examples in use are read from disk: the aligners keep the
+  view targets() of the target sentences, and the region features of
+  source_store(), on disk, so their memory does not grow with the number
+  of examples.
+
+  Parameters
+  ----------
+  src_store : RaggedArray of T_i x D region features
+  trg_store : RaggedArray or list of target sentences
+  src_ids, trg_ids : int arrays
+      The items of the stores of each example, all of them in order by default
+  max_src_len : int
+      The maximum number of regions of an example, all of them by default
+  pack_prefix : str
+      The files {pack_prefix}_values.npy and _offsets.npy of the region
+      features packed by source_store(), a temporary file by default
+  """
+  def __init__(self, src_store, trg_store,
+               src_ids=None, trg_ids=None,
+               max_src_len=None,
+               pack_prefix=None):
+    self.src_store = src_store
+    self.trg_store = trg_store
+    self.src_ids = np.arange(len(src_store)) if src_ids is None else np.asarray(src_ids, dtype=np.int64)
+    self.trg_ids = np.arange(len(trg_store)) if trg_ids is None else np.asarray(trg_ids, dtype=np.int64)
+    if len(self.src_ids) != len(self.trg_ids):
+      print('Warning: {} source and {} target sentences, keep the first {} pairs'.format(len(self.src_ids), len(self.trg_ids), len(self)))
+    self.max_src_len = max_src_len
+    self.pack_prefix = pack_prefix
+
+  def __len__(self):
+    return min(len(self.src_ids), len(self.trg_ids))
+
+  def source(self, i):
+    return np.asarray(self.src_store[self.src_ids[i]][:self.max_src_len], dtype=np.float32)
+
+  def target(self, i, null_id=None):
+    """Returns the i-th target sentence, with null_id prepended if given and the sentence is discrete"""
+    trg_sent = self.trg_store[self.trg_ids[i]]
+    if null_id is not None and is_discrete(trg_sent):
+      return np.asarray([null_id] + list(trg_sent))
+    return np.asarray(trg_sent)
+
+  def __getitem__(self, i):
+    return self.source(i), self.target(i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def sources(self):
+    return ExampleView(self, 'source')
+
+  def targets(self, null_id=None):
+    return ExampleView(self, 'target', null_id=null_id)
+
+  def to_lists(self):
+    """Returns the lists of the source and target features of every example, e.g., for a small test set"""
+    return list(self.sources()), list(self.targets())
+
+  def iterate_blocks(self, block_size, n_epochs=1, shuffle=False, seed=None, null_id=None):
+    """
+    Yields the examples block_size at a time, read when the block is needed,
+    as (source features, target features) lists, the same as
+    iterate_minibatches(), e.g., for trainStepwiseEM()
+    """
+    rng = np.random.RandomState(seed)
+    n = len(self)
+    for epoch in range(n_epochs):
+      order = rng.permutation(n) if shuffle else np.arange(n)
+      for start in range(0, n, block_size):
+        ex_ids = order[start:start+block_size]
+        src_feats = [self.source(i) for i in ex_ids]
+        trg_feats = [self.target(i, null_id) for i in ex_ids]
+        yield src_feats, trg_feats
+
+  def source_store(self, block_size=1024):
+    """
+    Returns the region features of every example as one RaggedArray, for
+    RegionVGMM. The features are used in place, e.g., memory-mapped, when
+    the examples are a contiguous and untruncated range of src_store, and
+    are otherwise packed block_size examples at a time into the store of
+    pack_prefix, or a temporary file removed once memory-mapped
+    """
+    src_ids = self.src_ids[:len(self)]
+    offsets = self.src_store.offsets
+    lens = offsets[src_ids+1] - offsets[src_ids]
+    if self.max_src_len is not None:
+      lens = np.minimum(lens, self.max_src_len)
+    contiguous = len(src_ids) > 0 and np.array_equal(src_ids, np.arange(src_ids[0], src_ids[0]+len(src_ids)))
+    if contiguous and np.array_equal(lens, offsets[src_ids+1] - offsets[src_ids]) and self.src_store.values.dtype == np.float32:
+      start, end = offsets[src_ids[0]], offsets[src_ids[-1]+1]
+      return RaggedArray(self.src_store.values[start:end], offsets[src_ids[0]:src_ids[-1]+2] - start)
+
+    if self.pack_prefix is None:
+      fd, values_file = tempfile.mkstemp(suffix='_values.npy')
+      os.close(fd)
+    else:
+      values_file = '{}_values.npy'.format(self.pack_prefix)
+    packed_offsets = np.zeros(len(src_ids)+1, dtype=np.int64)
+    packed_offsets[1:] = np.cumsum(lens)
+    values = np.lib.format.open_memmap(values_file, mode='w+', dtype=np.float32,
+                                       shape=(int(packed_offsets[-1]),)+self.src_store.values.shape[1:])
+    for start in range(0, len(src_ids), block_size):
+      block = self.src_store.take(src_ids[start:start+block_size], self.max_src_len, dtype=np.float32)
+      values[packed_offsets[start]:packed_offsets[start]+len(block.values)] = block.values
+    values.flush()
+    del values
+    logger.info('Packed the region features of {} examples into {}'.format(len(src_ids), values_file))
+    if self.pack_prefix is None:
+      # The mapping stays valid after the file is removed
+      values = np.load(values_file, mmap_mode='c')
+      os.remove(values_file)
+      return RaggedArray(values, packed_offsets)
+    np.save('{}_offsets.npy'.format(self.pack_prefix), packed_offsets)
+    return RaggedArray.load(self.pack_prefix, mmap_mode='c')
+
+class ExampleView(object):
+  """
+  Read-only sequence of the source or target features of the examples of an
+  AlignerDataset, each read when accessed; slices are returned as lists
+  """
+  def __init__(self, dataset, field, null_id=None):
+    self.dataset = dataset
+    self.field = field
+    self.null_id = null_id
+
+  def __len__(self):
+    return len(self.dataset)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    if self.field == 'source':
+      return self.dataset.source(i)
+    return self.dataset.target(i, self.null_id)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+def pack_prefix(path, name):
+  """Returns the prefix of the packed region features {name} in the directory path['pack_dir'], None (a temporary file) if not set"""
+  pack_dir = path.get('pack_dir', None)
+  return os.path.join(pack_dir, name) if pack_dir else None
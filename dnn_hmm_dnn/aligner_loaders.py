@@ -0,0 +1,206 @@
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+from aligner_utils import RaggedArray, segment_reduce
+from aligner_dataset import AlignerDataset, pack_prefix
+from feature_store import load_feature_store, store_prefix
+
+logger = logging.getLogger(__name__)
+OOV = -1
+
+def vocab_hash(word2idx):
+  return hashlib.sha1(json.dumps(word2idx, sort_keys=True).encode()).hexdigest()
+
+def caption_file_meta(caption_file, word2idx):
+  """The caption file (by path, size and modification time) and the vocabulary a token cache was built from"""
+  stat = os.stat(caption_file)
+  return {'caption_file': os.path.realpath(caption_file),
+          'size': stat.st_size,
+          'mtime_ns': stat.st_mtime_ns,
+          'vocab_hash': vocab_hash(word2idx)}
+
+def tokenize(caption_file, word2idx):
+  """
+  Returns
+  -------
+  tokens : RaggedArray of the int32 word ids of the captions, one per line,
+      with OOV for the words not in word2idx
+  """
+  with open(caption_file, 'r') as f:
+    text = f.read().rstrip('\n')
+  sents = [line.split() for line in text.split('\n')] if text else []
+  words = [w for sent in sents for w in sent]
+  offsets = np.zeros(len(sents)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(sent) for sent in sents])
+  if len(words) == 0:
+    return RaggedArray(np.zeros(0, dtype=np.int32), offsets)
+  # Look up each distinct word once
+  vocab, inverse = np.unique(np.asarray(words), return_inverse=True)
+  ids = np.asarray([word2idx.get(w, OOV) for w in vocab], dtype=np.int32)
+  return RaggedArray(ids[inverse.ravel()], offsets)
+
+def check_oov(tokens, ex_ids, caption_file):
+  """Raises a KeyError if the captions ex_ids of tokens have words not in the vocabulary, marked as OOV"""
+  n_oov = segment_reduce(np.add, (tokens.values == OOV).astype(np.int64), tokens.offsets)
+  ex_ids = np.asarray(ex_ids, dtype=np.int64)
+  bad = ex_ids[n_oov[ex_ids] > 0]
+  if len(bad) > 0:
+    raise KeyError('Caption {} of {} has words not in the vocabulary'.format(bad[0], caption_file))
+
+def load_tokens(caption_file, word2idx, skip_oov=False, strict=True):
+  """
+  Word ids of the captions of caption_file, tokenized once and cached as
+  int32 arrays with offsets ({caption file}_tokens_values.npy and
+  _tokens_offsets.npy) next to it. The cache is rebuilt when the caption
+  file or the vocabulary change, as recorded in _tokens_meta.json
+
+  Parameters
+  ----------
+  skip_oov : bool
+      Whether to drop the words not in word2idx, which otherwise raise a KeyError
+  strict : bool
+      If False, the words not in word2idx are kept as OOV, e.g., to be
+      checked by check_oov() on the captions in use only
+
+  Returns
+  -------
+  tokens : RaggedArray of word ids, one item per caption
+  """
+  prefix = '{}_tokens'.format(store_prefix(caption_file))
+  meta_file = '{}_meta.json'.format(prefix)
+  meta = caption_file_meta(caption_file, word2idx)
+  tokens = None
+  if os.path.isfile(meta_file):
+    with open(meta_file, 'r') as f:
+      if json.load(f) == meta:
+        tokens = RaggedArray.load(prefix, mmap_mode=None)
+
+  if tokens is None:
+    print('Tokenizing {} ...'.format(caption_file))
+    tokens = tokenize(caption_file, word2idx)
+    try:
+      # The meta file is written last, so an interrupted write is never used
+      if os.path.isfile(meta_file):
+        os.remove(meta_file)
+      tokens.save(prefix)
+      with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=4, sort_keys=True)
+    except OSError as e:
+      logger.info('Cannot cache the tokens of {}: {}'.format(caption_file, e))
+
+  oov = tokens.values == OOV
+  if np.any(oov) and (skip_oov or strict):
+    if not skip_oov:
+      raise KeyError('Words of {} are not in the vocabulary'.format(caption_file))
+    offsets = np.zeros(len(tokens)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(segment_reduce(np.add, (~oov).astype(np.int64), tokens.offsets))
+    tokens = RaggedArray(tokens.values[~oov], offsets)
+  return tokens
+
+def load_word2idx(path):
+  """Loads path['word_to_idx_file'], built from path['top_word_file'] if missing"""
+  word2idx_file = path['word_to_idx_file']
+  if not os.path.isfile(word2idx_file):
+    with open(path['top_word_file'], 'r') as f:
+      vocabs = f.read().strip().split('\n')
+
+    word2idx = {w:i for i, w in enumerate(vocabs)}
+    with open(word2idx_file, 'w') as f:
+      json.dump(word2idx, f, indent=4, sort_keys=True)
+  else:
+    with open(word2idx_file, 'r') as f:
+      word2idx = json.load(f)
+  return word2idx
+
+def read_split(split_file):
+  """Returns the line numbers of split_file equal to 1"""
+  with open(split_file, 'r') as f:
+    return [i for i, line in enumerate(f.read().strip().split('\n')) if line.strip() == '1']
+
+def load_mscoco(path, max_n_boxes=10):
+  """
+  Returns
+  -------
+  train_set, test_set : AlignerDatasets of the (image, caption) pairs. The
+      test captions are those of path['text_caption_file_test_retrieval'] if
+      it exists, and otherwise the captions of path['text_caption_file_test']
+      in the retrieval split
+  """
+  trg_feat_file_train = path['text_caption_file_train']
+  src_feat_file_train = path['image_feat_file_train']
+  trg_feat_file_test = path['text_caption_file_test_retrieval']
+  src_feat_file_test = path['image_feat_file_test']
+  trg_feat_file_test_full = path['text_caption_file_test']
+  retrieval_split = path['retrieval_split_file']
+  word2idx = load_word2idx(path)
+
+  trg_feats_train = load_tokens(trg_feat_file_train, word2idx)
+  if os.path.isfile(trg_feat_file_test):
+    trg_feats_test = load_tokens(trg_feat_file_test, word2idx, skip_oov=True) # XXX
+    trg_test_ex = np.arange(len(trg_feats_test))
+  else:
+    trg_feats_test = load_tokens(trg_feat_file_test_full, word2idx, skip_oov=True) # XXX
+    trg_test_ex = np.asarray([i for i in read_split(retrieval_split) if i < len(trg_feats_test)], dtype=np.int64) # XXX Choose the first out of five captions
+  trg_train_ex = np.arange(len(trg_feats_train))
+  if path.get('debug', False):
+    trg_train_ex, trg_test_ex = trg_train_ex[:20], trg_test_ex[:20]
+
+  src_store_train = load_feature_store(src_feat_file_train, cache_dir=path.get('feature_cache_dir', None))
+  src_store_test = load_feature_store(src_feat_file_test, cache_dir=path.get('feature_cache_dir', None))
+  print('Number of training target sentences={}, number of training source sentences={}'.format(len(trg_train_ex), len(src_store_train)))
+  print('Number of test target sentences={}, number of test source sentences={}'.format(len(trg_test_ex), len(src_store_test)))
+
+  if len(src_store_test) > 1000:
+    test_indices = set(read_split(retrieval_split))
+    test_ex = [ex for ex, k in enumerate(src_store_test.keys) if int(k.split('_')[-1]) in test_indices] # XXX
+  else:
+    test_ex = np.arange(len(src_store_test))
+
+  train_set = AlignerDataset(src_store_train, trg_feats_train,
+                             trg_ids=trg_train_ex,
+                             max_src_len=max_n_boxes,
+                             pack_prefix=pack_prefix(path, 'mscoco_train_regions')) # XXX
+  test_set = AlignerDataset(src_store_test, trg_feats_test, src_ids=test_ex, trg_ids=trg_test_ex, max_src_len=max_n_boxes) # XXX
+  return train_set, test_set
+
+def load_flickr(path):
+  """
+  Returns
+  -------
+  train_set, test_set : AlignerDatasets of the (image, caption) pairs, with
+      the first caption of each test image in the test set
+  """
+  trg_feat_file = path['text_caption_file']
+  src_feat_file = path['image_feat_file']
+  test_image_ids_file = path['test_image_ids_file']
+  with open(path['word_to_idx_file'], 'r') as f:
+    word2idx = json.load(f)
+
+  with open(test_image_ids_file, 'r') as f:
+    test_image_ids = set('_'.join(line.split('_')[0:2]) for ex, line in enumerate(f)) # XXX
+
+  # Only the captions in use have to be in the vocabulary, checked below
+  trg_feats = load_tokens(trg_feat_file, word2idx, strict=False)
+  src_store = load_feature_store(src_feat_file, cache_dir=path.get('feature_cache_dir', None))
+  image_ids = src_store.keys # XXX
+
+  # Split the features into train and test sets
+  train_ex = []
+  test_ex = []
+  for ex, img_id in enumerate(image_ids):
+    if img_id.split('.')[0] in test_image_ids:
+      if img_id.split('_')[2] == '1': # Select one caption per image for the test set (Pick the first caption for each image)
+        test_ex.append(ex)
+    else:
+      train_ex.append(ex)
+  if path.get('debug', False):
+    train_ex, test_ex = train_ex[:20], test_ex[:20]
+  check_oov(trg_feats, train_ex + test_ex, trg_feat_file)
+  train_set = AlignerDataset(src_store, trg_feats, src_ids=train_ex, trg_ids=train_ex, pack_prefix=pack_prefix(path, 'flickr_train_regions'))
+  test_set = AlignerDataset(src_store, trg_feats, src_ids=test_ex, trg_ids=test_ex)
+
+  print('Number of training target sentences={}, number of training source sentences={}'.format(len(train_ex), len(train_ex)))
+  print('Number of test target sentences={}, number of test source sentences={}'.format(len(test_ex), len(test_ex)))
+  return train_set, test_set
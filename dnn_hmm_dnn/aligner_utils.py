@@ -0,0 +1,344 @@
+import numpy as np
+
+TINY = np.finfo(float).tiny
+
+class SparsePosteriors(object):
+  """
+  Top-k soft vectors of a continuous target sentence: the L x k int32 indices
+  of the k most probable codebook entries of each frame and their L x k
+  float32 weights, renormalized to sum to one
+
+  Parameters
+  ----------
+  indices : L x k int array
+  weights : L x k float array
+  """
+  def __init__(self, indices, weights):
+    self.indices = indices
+    self.weights = weights
+
+  @classmethod
+  def from_dense(cls, probs, k):
+    """Keeps the k largest entries of each row of the L x K array probs"""
+    probs = np.asarray(probs)
+    k = min(k, probs.shape[-1])
+    indices = np.argpartition(-probs, k-1, axis=-1)[:, :k]
+    weights = np.take_along_axis(probs, indices, axis=-1)
+    weights = weights / np.maximum(np.sum(weights, axis=-1, keepdims=True), TINY)
+    return cls(indices.astype(np.int32), weights.astype(np.float32))
+
+  def to_dense(self, K):
+    V = np.zeros((len(self), K))
+    np.put_along_axis(V, self.indices.astype(np.int64), self.weights, axis=-1)
+    return V
+
+  def __len__(self):
+    return len(self.indices)
+
+class SparsePosteriorsArray(object):
+  """
+  A list of SparsePosteriors stored as two contiguous N x k arrays of indices
+  and weights and their offsets, like RaggedArray
+  """
+  def __init__(self, indices, weights, offsets):
+    self.indices = indices
+    self.weights = weights
+    self.offsets = offsets
+
+  @classmethod
+  def from_dense(cls, sents, k):
+    sparse_sents = [SparsePosteriors.from_dense(sent, k) for sent in sents]
+    indices = RaggedArray.from_list([sent.indices for sent in sparse_sents], dtype=np.int32)
+    weights = RaggedArray.from_list([sent.weights for sent in sparse_sents], dtype=np.float32)
+    return cls(indices.values, weights.values, indices.offsets)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return SparsePosteriors(self.indices[self.offsets[i]:self.offsets[i+1]], 
+                            self.weights[self.offsets[i]:self.offsets[i+1]])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+def is_sparse(sent):
+  return isinstance(sent, SparsePosteriors)
+
+def is_discrete(sent):
+  return not is_sparse(sent) and np.ndim(sent) < 2
+
+def to_sparse(sents, k):
+  """Converts the continuous sentences of sents to SparsePosteriors with the top k entries, if k is given"""
+  if not k:
+    return sents
+  return [SparsePosteriors.from_dense(sent, k) if not is_discrete(sent) and not is_sparse(sent) else sent for sent in sents]
+
+def to_padded_sparse(sents):
+  """
+  Returns
+  -------
+  indices : B x L_max x k_max int array of codebook indices, zero-padded
+  weights : B x L_max x k_max array of their weights, zero-padded
+  mask : B x L_max array, 1 for valid positions and 0 for padding
+  """
+  lens = [len(sent) for sent in sents]
+  L = max(max(lens, default=0), 1)
+  k = max([sent.indices.shape[-1] for sent in sents if len(sent) > 0], default=1)
+  indices = np.zeros((len(sents), L, k), dtype=np.int64)
+  weights = np.zeros((len(sents), L, k))
+  mask = np.zeros((len(sents), L))
+  for b, sent in enumerate(sents):
+    k_b = sent.indices.shape[-1] if len(sent) > 0 else 0
+    indices[b, :lens[b], :k_b] = sent.indices
+    weights[b, :lens[b], :k_b] = sent.weights
+    mask[b, :lens[b]] = 1.
+  return indices, weights, mask
+
+def to_one_hot(sent, K):
+  if is_sparse(sent):
+    return sent.to_dense(K)
+  sent = np.asarray(sent)
+  if len(sent.shape) < 2:
+    idx = sent.astype(int)
+    oov = idx >= K
+    V = np.zeros((len(idx), K))
+    V[np.arange(len(idx))[~oov], idx[~oov]] = 1.
+    V[oov] = 1./K
+    return V
+  else:
+    return sent
+
+def to_padded_one_hot(sents, K):
+  """
+  Returns
+  -------
+  V : B x L_max x K zero-padded array of one-hot (or soft) vectors
+  mask : B x L_max array, 1 for valid positions and 0 for padding
+  """
+  lens = [len(sent) for sent in sents]
+  L = max(max(lens, default=0), 1)
+  V = np.zeros((len(sents), L, K))
+  mask = np.zeros((len(sents), L))
+  for b, sent in enumerate(sents):
+    if lens[b] > 0:
+      V[b, :lens[b]] = to_one_hot(sent, K)
+      mask[b, :lens[b]] = 1.
+  return V, mask
+
+def to_padded_index(sents):
+  """
+  Returns
+  -------
+  idx : B x L_max int array of word indices, zero-padded
+  mask : B x L_max array, 1 for valid positions and 0 for padding
+  """
+  lens = [len(sent) for sent in sents]
+  L = max(max(lens, default=0), 1)
+  idx = np.zeros((len(sents), L), dtype=np.int64)
+  mask = np.zeros((len(sents), L))
+  for b, sent in enumerate(sents):
+    idx[b, :lens[b]] = sent
+    mask[b, :lens[b]] = 1.
+  return idx, mask
+
+def gather_rows(P, idx):
+  """
+  Equivalent to to_one_hot(idx, K) @ P for any shape of idx, i.e.,
+  P[idx] with a uniform mixture of the rows for out-of-vocabulary indices
+  """
+  idx = np.asarray(idx, dtype=np.int64)
+  oov = idx >= P.shape[0]
+  rows = P[np.where(oov, 0, idx)]
+  if np.any(oov):
+    rows[oov] = np.mean(P, axis=0)
+  return rows
+
+def scatter_rows(C, idx, W):
+  """
+  In-place equivalent of C += to_one_hot(idx, K).T @ W, with idx of shape
+  (N,) and W of shape (N, C.shape[1])
+  """
+  idx = np.asarray(idx, dtype=np.int64)
+  oov = idx >= C.shape[0]
+  np.add.at(C, idx[~oov], W[~oov])
+  if np.any(oov):
+    C += np.sum(W[oov], axis=0) / C.shape[0]
+  return C
+
+def gather_sent(sent, P):
+  """Returns to_one_hot(sent, K) @ P, by row gathers for discrete and sparse sentences"""
+  if is_discrete(sent):
+    return gather_rows(P, sent)
+  if is_sparse(sent):
+    return np.einsum('lj,ljs->ls', sent.weights, P[sent.indices])
+  return np.asarray(sent) @ P
+
+def scatter_sent(C, sent, W):
+  """In-place equivalent of C += to_one_hot(sent, K).T @ W"""
+  if is_discrete(sent):
+    return scatter_rows(C, sent, W)
+  if is_sparse(sent):
+    return scatter_rows(C, sent.indices.ravel(), (sent.weights[:, :, np.newaxis] * W[:, np.newaxis]).reshape(-1, W.shape[-1]))
+  C += np.asarray(sent).T @ W
+  return C
+
+def align_block(src_sents, trg_sents, P_ts):
+  """
+  Parameters
+  ----------
+  src_sents : list of T_b x Ks arrays of concept probabilities of the source regions
+  trg_sents : list of target sentences (word indices or Kt-dim soft vectors)
+
+  Returns
+  -------
+  P_a : B x T x L zero-padded array of the alignment probabilities, 
+        P_a[b, t, l] = src_sents[b][t] . P_ts[trg_sents[b][l]]
+  src_mask : B x T array, 1 for valid source positions and 0 for padding
+  trg_mask : B x L array, 1 for valid target positions and 0 for padding
+  """
+  V_src, src_mask = to_padded_one_hot(src_sents, P_ts.shape[1])
+  if is_discrete(trg_sents[0]):
+    trg_ids, trg_mask = to_padded_index(trg_sents)
+    P_trg = gather_rows(P_ts, trg_ids) * trg_mask[:, :, np.newaxis]
+  elif is_sparse(trg_sents[0]):
+    trg_ids, W_trg, trg_mask = to_padded_sparse(trg_sents)
+    P_trg = np.einsum('blj,bljs->bls', W_trg, P_ts[trg_ids])
+  else:
+    V_trg, trg_mask = to_padded_one_hot(trg_sents, P_ts.shape[0])
+    P_trg = V_trg @ P_ts
+  return V_src @ np.swapaxes(P_trg, 1, 2), src_mask, trg_mask
+
+class RaggedArray(object):
+  """
+  A list of variable-length arrays stored as one contiguous array of values
+  and an int64 offsets array, so that the i-th item is the zero-copy slice 
+  values[offsets[i]:offsets[i+1]]. The values can be an np.memmap (see load())
+  """
+  def __init__(self, values, offsets):
+    self.values = values
+    self.offsets = offsets
+
+  @classmethod
+  def from_list(cls, arrays, dtype=None):
+    lens = [len(a) for a in arrays]
+    offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lens)
+    nonempty = [np.asarray(a, dtype=dtype) for a in arrays if len(a) > 0]
+    if len(nonempty) > 0:
+      values = np.concatenate(nonempty, axis=0)
+    else:
+      values = np.zeros((0,), dtype=dtype)
+    return cls(values, offsets)
+
+  def save(self, prefix):
+    np.save('{}_values.npy'.format(prefix), self.values)
+    np.save('{}_offsets.npy'.format(prefix), self.offsets)
+
+  @classmethod
+  def load(cls, prefix, mmap_mode='r'):
+    """Loads a store written by save(), with the values memory-mapped by default"""
+    return cls(np.load('{}_values.npy'.format(prefix), mmap_mode=mmap_mode),
+               np.load('{}_offsets.npy'.format(prefix)))
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.values[self.offsets[i]:self.offsets[i+1]]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def take(self, indices, max_len=None, dtype=None):
+    """
+    Returns a RaggedArray of the items indices, each truncated to its first
+    max_len rows if given, gathered from the values in one pass
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = self.offsets[indices]
+    lens = self.offsets[indices+1] - starts
+    if max_len is not None:
+      lens = np.minimum(lens, max_len)
+    offsets = np.zeros(len(indices)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lens)
+    rows = np.repeat(starts - offsets[:-1], lens) + np.arange(offsets[-1])
+    return RaggedArray(np.asarray(self.values[rows], dtype=dtype), offsets)
+
+def iterate_minibatches(source_features, target_features, batch_size, n_epochs=1, shuffle=True, seed=None):
+  """Yields (source features, target features) mini-batches of in-memory training data"""
+  rng = np.random.RandomState(seed)
+  n = len(source_features)
+  for epoch in range(n_epochs):
+    order = rng.permutation(n) if shuffle else np.arange(n)
+    for start in range(0, n, batch_size):
+      ex_ids = order[start:start+batch_size]
+      yield [source_features[i] for i in ex_ids], [target_features[i] for i in ex_ids]
+
+def segment_reduce(ufunc, M, offsets, axis=0):
+  """
+  Reduces M with ufunc (e.g., np.add or np.maximum) over the segments 
+  offsets[i]:offsets[i+1] along the axis, with zeros for empty segments
+  """
+  lens = np.diff(offsets)
+  shape = list(M.shape)
+  shape[axis] = len(lens)
+  out = np.zeros(shape, dtype=M.dtype)
+  nonempty = lens > 0
+  if np.any(nonempty):
+    index = [slice(None)] * M.ndim
+    index[axis] = nonempty
+    out[tuple(index)] = ufunc.reduceat(M, offsets[:-1][nonempty], axis=axis)
+  return out
+
+def log_max_product_scores(src_probs, trg_probs, score_type='max', block_size=64):
+  """
+  Log retrieval scores of every (source, target) pair, 
+
+    scores[i, j] = sum_t log max_l (trg_probs[j] @ src_probs[i].T)[l, t], 
+
+  (or the mean over l for score_type='mean'), computed with one matrix 
+  product per block of sources and block of targets
+
+  Parameters
+  ----------
+  src_probs : RaggedArray of the T_i x K concept posteriors of each source sentence
+  trg_probs : RaggedArray of the L_j x K translation probabilities of each target sentence
+  block_size : int
+      The number of sentences per block on either side
+
+  Returns
+  -------
+  scores : n_src x n_trg array
+  """
+  scores = np.zeros((len(src_probs), len(trg_probs)))
+  for i0, j0, block in iterate_score_blocks(src_probs, trg_probs, score_type, block_size):
+    scores[i0:i0+block.shape[0], j0:j0+block.shape[1]] = block
+  return scores
+
+def iterate_score_blocks(src_probs, trg_probs, score_type='max', block_size=64, blocks=None):
+  """
+  Yields (i0, j0, scores[i0:i0+block_size, j0:j0+block_size]) for the blocks
+  of the score matrix of log_max_product_scores() in row-major order, or
+  for the (i0, j0) of blocks in that order if given
+  """
+  if not score_type in ['max', 'mean']:
+    raise ValueError('Score type not implemented')
+  if blocks is None:
+    blocks = [(i0, j0) for i0 in range(0, len(src_probs), block_size) for j0 in range(0, len(trg_probs), block_size)]
+  for i0, j0 in blocks:
+    src_offsets = src_probs.offsets[i0:i0+block_size+1]
+    S = src_probs.values[src_offsets[0]:src_offsets[-1]]
+    src_offsets = src_offsets - src_offsets[0]
+    trg_offsets = trg_probs.offsets[j0:j0+block_size+1]
+    W = trg_probs.values[trg_offsets[0]:trg_offsets[-1]]
+    trg_offsets = trg_offsets - trg_offsets[0]
+    P_a = W @ S.T
+    if score_type == 'max':
+      P_a = segment_reduce(np.maximum, P_a, trg_offsets, axis=0)
+    else:
+      P_a = segment_reduce(np.add, P_a, trg_offsets, axis=0) / np.maximum(np.diff(trg_offsets), 1)[:, np.newaxis]
+    log_P_a = np.log(np.maximum(P_a, TINY))
+    yield i0, j0, segment_reduce(np.add, log_P_a, src_offsets, axis=1).T
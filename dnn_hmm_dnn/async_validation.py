@@ -0,0 +1,82 @@
+import logging
+import multiprocessing as mp
+from collections import deque
+
+logger = logging.getLogger(__name__)
+_validator = {}
+
+# Attributes left out of the snapshots: the training data, the E-step
+# statistics and the backend with its work buffers
+SNAPSHOT_EXCLUDE = ['src_model', 'trg_feats', 'trg2src_counts', 'backend']
+
+def logging_config():
+  """Returns the logging.basicConfig() arguments of the log file of the root logger, None if it has none"""
+  root = logging.getLogger()
+  for handler in root.handlers:
+    if isinstance(handler, logging.FileHandler):
+      return {'filename': handler.baseFilename,
+              'format': handler.formatter._fmt if handler.formatter else None,
+              'level': root.level}
+  return None
+
+def snapshot_aligner(aligner):
+  """
+  Returns a copy of the aligner with its current P_ts and means, without the
+  training data, that can be used for align_sents() and retrieve() while the
+  aligner keeps training
+  """
+  snapshot = aligner.__class__.__new__(aligner.__class__)
+  snapshot.__dict__.update({k:v for k, v in aligner.__dict__.items() if not k in SNAPSHOT_EXCLUDE})
+  snapshot.P_ts = aligner.P_ts.copy()
+  snapshot.src_model = aligner.src_model.snapshot()
+  snapshot.backend = None
+  return snapshot
+
+class AsyncValidator(object):
+  """
+  Runs aligner.validate() on frozen snapshots of the aligner in background
+  processes while EM goes on. At most max_in_flight validations are pending
+  at a time; submitting another one first waits for the oldest to finish.
+  The workers are spawned rather than forked, since forking after the
+  BLAS/OpenMP thread pools of torch and numpy are started can deadlock,
+  and log to the log file of the parent.
+
+  Parameters
+  ----------
+  source_features_val, target_features_val : lists of validation features,
+      sent to the workers once
+  max_in_flight : int
+      The number of worker processes and of pending validations
+  """
+  def __init__(self, source_features_val, target_features_val, max_in_flight=1):
+    self.max_in_flight = max_in_flight
+    self.pending = deque()
+    self.pool = mp.get_context('spawn').Pool(max_in_flight,
+                                             initializer=_init_validator,
+                                             initargs=(source_features_val, target_features_val, logging_config()))
+
+  def submit(self, aligner, out_file, i_iter):
+    while len(self.pending) >= self.max_in_flight:
+      self.wait_oldest()
+    self.pending.append((i_iter, self.pool.apply_async(_validate, (snapshot_aligner(aligner), out_file, i_iter))))
+
+  def wait_oldest(self):
+    i_iter, result = self.pending.popleft()
+    result.get()
+    logger.info('Validation of iteration {} done'.format(i_iter))
+
+  def close(self):
+    while len(self.pending) > 0:
+      self.wait_oldest()
+    self.pool.close()
+    self.pool.join()
+
+def _init_validator(source_features_val, target_features_val, log_config):
+  # The spawned workers do not run the logging setup of the entry points
+  if log_config is not None:
+    logging.basicConfig(**log_config)
+  _validator['source_features_val'] = source_features_val
+  _validator['target_features_val'] = target_features_val
+
+def _validate(aligner, out_file, i_iter):
+  aligner.validate(_validator['source_features_val'], _validator['target_features_val'], out_file, i_iter)
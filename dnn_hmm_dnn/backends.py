@@ -0,0 +1,160 @@
+import numpy as np
+import torch
+from forward_backward import BatchForwardBackward, StayJumpTransitions
+
+class NumpyBackend(object):
+  """
+  Batched E- and M-step kernels of the mixture aligners in NumPy. The inputs
+  are zero-padded blocks of examples and the outputs are NumPy arrays.
+  """
+  def __init__(self, dtype='float64', eps=1e-15):
+    self.dtype = np.dtype(dtype)
+    self.eps = eps
+    self.fb = BatchForwardBackward(dtype=self.dtype)
+
+  def array(self, x):
+    return np.asarray(x, dtype=self.dtype)
+
+  def mixture_counts(self, P_trg, V_src, trg_mask, src_mask):
+    """
+    E-step of the continuous mixture aligner
+
+    Parameters
+    ----------
+    P_trg : B x L x Ks array of the translation probability rows of the target words
+    V_src : B x T x Ks array of unnormalized concept probabilities of the source regions
+    trg_mask : B x L array
+    src_mask : B x T array
+
+    Returns
+    -------
+    W : B x L x Ks array of expected counts, to be scattered to the target words 
+    log_probs : length B vector of log likelihoods
+    """
+    P_trg, V_src, trg_mask, src_mask = map(self.array, (P_trg, V_src, trg_mask, src_mask))
+    trg_lens = np.maximum(np.sum(trg_mask, axis=1), 1)
+    # (B, L, T), padded rows and columns are zero
+    P_a = P_trg @ V_src.transpose(0, 2, 1)
+    log_probs = np.sum(np.log(np.maximum(np.sum(P_a, axis=1) / trg_lens[:, np.newaxis], self.eps)) * src_mask, axis=1)
+    C_a = P_a / np.maximum(np.sum(P_a, axis=1, keepdims=True), self.eps)
+    V_src = V_src / np.maximum(np.sum(V_src, axis=2, keepdims=True), self.eps)
+    return C_a @ V_src, log_probs
+
+  def forward_backward(self, probs, trg_sent, init, A, src_mask):
+    """See BatchForwardBackward.run"""
+    probs, trg_sent, init, src_mask = map(self.array, (probs, trg_sent, init, src_mask))
+    return self.fb.run(probs, trg_sent, init, A, src_mask)
+
+  def component_stats(self, prob_f_given_x, prob_f_given_y, X, src_mask):
+    """
+    M-step sufficient statistics of the region mixture model
+
+    Parameters
+    ----------
+    prob_f_given_x : B x T x Ks array of concept posteriors of the source regions
+    prob_f_given_y : B x Ks array of concept probabilities given the target sentences
+    X : B x T x D array of source region features
+    src_mask : B x T array
+
+    Returns
+    -------
+    means_new : Ks x D array of posterior-weighted sums of the region features
+    counts : length Ks vector of posterior counts
+    """
+    prob_f_given_x, prob_f_given_y, X, src_mask = map(self.array, (prob_f_given_x, prob_f_given_y, X, src_mask))
+    post_f = prob_f_given_x * prob_f_given_y[:, np.newaxis]
+    post_f *= (src_mask / np.maximum(np.sum(post_f, axis=2), self.eps))[:, :, np.newaxis]
+    B, T, Ks = post_f.shape
+    means_new = post_f.reshape(B*T, Ks).T @ X.reshape(B*T, -1)
+    return means_new, np.sum(post_f, axis=(0, 1))
+
+  def einsum(self, subscripts, *operands):
+    return np.einsum(subscripts, *map(self.array, operands), optimize=True)
+
+class TorchBackend(NumpyBackend):
+  """
+  The kernels of NumpyBackend as batched torch operations on CPU, which run 
+  on torch.get_num_threads() threads. The inputs and outputs are NumPy arrays; 
+  the outputs share memory with the torch results.
+  """
+  def __init__(self, dtype='float32', eps=1e-15, n_threads=None):
+    self.dtype = getattr(torch, dtype)
+    self.eps = eps
+    if n_threads:
+      torch.set_num_threads(n_threads)
+
+  def array(self, x):
+    return torch.as_tensor(np.asarray(x)).to(self.dtype)
+
+  def mixture_counts(self, P_trg, V_src, trg_mask, src_mask):
+    P_trg, V_src, trg_mask, src_mask = map(self.array, (P_trg, V_src, trg_mask, src_mask))
+    with torch.no_grad():
+      trg_lens = torch.clamp(torch.sum(trg_mask, dim=1), min=1)
+      P_a = P_trg @ V_src.transpose(1, 2)
+      log_probs = torch.sum(torch.log(torch.clamp(torch.sum(P_a, dim=1) / trg_lens.unsqueeze(1), min=self.eps)) * src_mask, dim=1)
+      C_a = P_a / torch.clamp(torch.sum(P_a, dim=1, keepdim=True), min=self.eps)
+      V_src = V_src / torch.clamp(torch.sum(V_src, dim=2, keepdim=True), min=self.eps)
+      return (C_a @ V_src).numpy(), log_probs.numpy()
+
+  def forward_backward(self, probs, trg_sent, init, A, src_mask):
+    probs, trg_sent, init, src_mask = map(self.array, (probs, trg_sent, init, src_mask))
+    if isinstance(A, StayJumpTransitions):
+      stay, jump, weights = map(self.array, (A.stay, A.jump, A.weights))
+      jump_forward = lambda m: weights * (torch.sum(jump * m, dim=-1, keepdim=True) - jump * m)
+      jump_backward = lambda m: jump * (torch.sum(weights * m, dim=-1, keepdim=True) - weights * m)
+      A_diag = stay.unsqueeze(-1)
+    else:
+      A = self.array(A if isinstance(A, np.ndarray) else A.A)
+      A_offdiag = A * (1. - torch.eye(A.size(-1), dtype=self.dtype))
+      jump_forward = lambda m: torch.einsum('bij,bi->bj', [A_offdiag, m])
+      jump_backward = lambda m: torch.einsum('bij,bj->bi', [A_offdiag, m])
+      A_diag = torch.diagonal(A, dim1=1, dim2=2).unsqueeze(-1)
+
+    with torch.no_grad():
+      B, T = src_mask.shape
+      L = trg_sent.size(1)
+      K = max(probs.size(-1), trg_sent.size(-1))
+      forward_probs = torch.zeros((B, T, L, K), dtype=self.dtype)
+      backward_probs = torch.ones((B, T, L, K), dtype=self.dtype)
+      scales = torch.ones((B, T), dtype=self.dtype)
+      for t in range(T):
+        if t == 0:
+          forward_probs[:, 0] = init.unsqueeze(-1) * trg_sent * probs[:, 0]
+        else:
+          jump_probs = jump_forward(torch.sum(forward_probs[:, t-1], dim=-1))
+          forward_probs[:, t] = (A_diag * forward_probs[:, t-1] + jump_probs.unsqueeze(-1) * trg_sent) * probs[:, t]
+        scales[:, t] = torch.where(src_mask[:, t] > 0, torch.sum(forward_probs[:, t], dim=(1, 2)), scales[:, t])
+        forward_probs[:, t] /= torch.clamp(scales[:, t], min=self.eps).view(B, 1, 1)
+
+      for t in range(T-1, 0, -1):
+        emit_probs = backward_probs[:, t] * probs[:, t]
+        jump_probs = jump_backward(torch.sum(emit_probs * trg_sent, dim=-1))
+        backward_probs_t = (A_diag * emit_probs + jump_probs.unsqueeze(-1)) / torch.clamp(scales[:, t], min=self.eps).view(B, 1, 1)
+        # Position t-1 is the last one of the examples of length t
+        backward_probs[:, t-1] = torch.where((src_mask[:, t] > 0).view(B, 1, 1), backward_probs_t, backward_probs[:, t-1])
+
+      post_probs = forward_probs * backward_probs
+      post_probs *= (src_mask / torch.clamp(torch.sum(post_probs, dim=(2, 3)), min=self.eps)).unsqueeze(-1).unsqueeze(-1)
+      log_probs = torch.sum(torch.log(torch.clamp(scales, min=self.eps)) * src_mask, dim=1)
+      return post_probs.numpy(), log_probs.numpy()
+
+  def component_stats(self, prob_f_given_x, prob_f_given_y, X, src_mask):
+    prob_f_given_x, prob_f_given_y, X, src_mask = map(self.array, (prob_f_given_x, prob_f_given_y, X, src_mask))
+    with torch.no_grad():
+      post_f = prob_f_given_x * prob_f_given_y.unsqueeze(1)
+      post_f *= (src_mask / torch.clamp(torch.sum(post_f, dim=2), min=self.eps)).unsqueeze(-1)
+      B, T, Ks = post_f.shape
+      means_new = post_f.reshape(B*T, Ks).t() @ X.reshape(B*T, -1)
+      return means_new.numpy(), torch.sum(post_f, dim=(0, 1)).numpy()
+
+  def einsum(self, subscripts, *operands):
+    with torch.no_grad():
+      return torch.einsum(subscripts, list(map(self.array, operands))).numpy()
+
+def get_backend(name='numpy', dtype='float64', eps=1e-15, n_threads=None):
+  if name == 'numpy':
+    return NumpyBackend(dtype=dtype, eps=eps)
+  elif name == 'torch':
+    return TorchBackend(dtype=dtype, eps=eps, n_threads=n_threads)
+  else:
+    raise ValueError('Backend {} not implemented'.format(name))
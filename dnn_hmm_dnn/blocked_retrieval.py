@@ -0,0 +1,116 @@
+import numpy as np
+from aligner_utils import iterate_score_blocks
+
+class BlockedRetrieval(object):
+  """
+  Streaming top-k retrieval over a score matrix computed block by block, for
+  galleries whose n_src x n_trg score matrix does not fit in memory. Keeps
+  the k best targets of every source and the k best sources of every target,
+  and counts the rank of the matching pair (the i-th target for the i-th
+  source) in both directions as the blocks come in (see rank_metrics()).
+  Ties are broken by index, as by matching_ranks() and a stable sort of the
+  scores, so the results do not depend on the order of the blocks.
+
+  Parameters
+  ----------
+  n_src, n_trg : int
+      The numbers of source and target sentences
+  kbest : int
+      The number of best candidates kept in each direction
+  scores_file : str
+      If given, the .npy file, memory-mapped, to which the score blocks are written
+  """
+  def __init__(self, n_src, n_trg, kbest=10, scores_file=None):
+    self.n_src = n_src
+    self.n_trg = n_trg
+    k_trg, k_src = min(kbest, n_trg), min(kbest, n_src)
+    self.trg_kbest_scores = np.full((n_src, k_trg), -np.inf)
+    self.trg_kbest_ids = np.full((n_src, k_trg), -1, dtype=np.int64)
+    self.src_kbest_scores = np.full((n_trg, k_src), -np.inf)
+    self.src_kbest_ids = np.full((n_trg, k_src), -1, dtype=np.int64)
+    # Scores of the matching pairs and number of candidates ranked above them
+    n_pairs = min(n_src, n_trg)
+    self.matching_scores = np.zeros(n_pairs)
+    self.trg_ranks = np.zeros(n_pairs, dtype=np.int64)
+    self.src_ranks = np.zeros(n_pairs, dtype=np.int64)
+    self.scores = None
+    if scores_file:
+      self.scores = np.lib.format.open_memmap(scores_file, mode='w+', dtype=np.float64, shape=(n_src, n_trg))
+
+  def run(self, src_probs, trg_probs, score_type='max', block_size=256):
+    """
+    Scores all pairs of log_max_product_scores(src_probs, trg_probs) block
+    by block, with each diagonal block before the blocks whose ranks need
+    its matching scores
+    """
+    src_starts = range(0, len(src_probs), block_size)
+    trg_starts = range(0, len(trg_probs), block_size)
+    blocks = []
+    for b in range(max(len(src_starts), len(trg_starts))):
+      if b < len(src_starts) and b < len(trg_starts):
+        blocks.append((src_starts[b], trg_starts[b]))
+      for c in range(b):
+        if b < len(src_starts) and c < len(trg_starts):
+          blocks.append((src_starts[b], trg_starts[c]))
+        if c < len(src_starts) and b < len(trg_starts):
+          blocks.append((src_starts[c], trg_starts[b]))
+
+    for i0, j0, block in iterate_score_blocks(src_probs, trg_probs, score_type, block_size, blocks=blocks):
+      if i0 == j0:
+        n = min(block.shape)
+        self.matching_scores[i0:i0+n] = np.diagonal(block)[:n]
+      self.update(i0, j0, block)
+    if self.scores is not None:
+      self.scores.flush()
+
+  def update(self, i0, j0, block):
+    """Merges the block scores[i0:i0+B1, j0:j0+B2] into the top-k buffers and the ranks"""
+    src_ids = np.arange(i0, i0+block.shape[0])
+    trg_ids = np.arange(j0, j0+block.shape[1])
+    rows = slice(i0, i0+block.shape[0])
+    cols = slice(j0, j0+block.shape[1])
+    if self.scores is not None:
+      self.scores[rows, cols] = block
+
+    self.trg_kbest_scores[rows], self.trg_kbest_ids[rows] =\
+      merge_kbest(self.trg_kbest_scores[rows], self.trg_kbest_ids[rows], block, trg_ids)
+    self.src_kbest_scores[cols], self.src_kbest_ids[cols] =\
+      merge_kbest(self.src_kbest_scores[cols], self.src_kbest_ids[cols], block.T, src_ids)
+
+    # Ties are ranked by index, as with a stable sort of the scores
+    n_pairs = len(self.matching_scores)
+    src_pairs = src_ids[src_ids < n_pairs]
+    if len(src_pairs) > 0:
+      gold = self.matching_scores[src_pairs, np.newaxis]
+      above = (block[:len(src_pairs)] > gold) | ((block[:len(src_pairs)] == gold) & (trg_ids < src_pairs[:, np.newaxis]))
+      self.trg_ranks[src_pairs] += np.sum(above, axis=1)
+    trg_pairs = trg_ids[trg_ids < n_pairs]
+    if len(trg_pairs) > 0:
+      gold = self.matching_scores[trg_pairs]
+      above = (block[:, :len(trg_pairs)] > gold) | ((block[:, :len(trg_pairs)] == gold) & (src_ids[:, np.newaxis] < trg_pairs))
+      self.src_ranks[trg_pairs] += np.sum(above, axis=0)
+
+  def trg_kbest(self):
+    """Returns the n_src x k best targets of every source, best first"""
+    return sort_kbest(self.trg_kbest_scores, self.trg_kbest_ids)
+
+  def src_kbest(self):
+    """Returns the n_trg x k best sources of every target, best first"""
+    return sort_kbest(self.src_kbest_scores, self.src_kbest_ids)
+
+def merge_kbest(kbest_scores, kbest_ids, scores, ids):
+  """Merges the candidates ids with scores (N x M) into the N x k buffers of the best ones so far, best first"""
+  k = kbest_scores.shape[1]
+  cand_scores = np.concatenate([kbest_scores, scores], axis=1)
+  cand_ids = np.concatenate([kbest_ids, np.broadcast_to(ids, scores.shape)], axis=1)
+  top = rank_candidates(cand_scores, cand_ids)[:, :k]
+  return np.take_along_axis(cand_scores, top, axis=1), np.take_along_axis(cand_ids, top, axis=1)
+
+def rank_candidates(scores, ids):
+  """Returns the order of the candidates by decreasing score and then increasing id, with the empty slots (id -1) last"""
+  ids = np.where(ids < 0, np.iinfo(np.int64).max, ids)
+  return np.lexsort((ids, -scores), axis=-1)
+
+def sort_kbest(kbest_scores, kbest_ids):
+  order = rank_candidates(kbest_scores, kbest_ids)
+  return np.take_along_axis(kbest_ids, order, axis=1)
@@ -0,0 +1,56 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+# Configs that do not change the model, so that a run can be resumed with,
+# e.g., a different number of workers
+RUNTIME_CONFIGS = ['n_workers', 'batch_size', 'backend', 'dtype', 'n_threads', 'cache_posteriors', 'max_val_in_flight', 'alignment_format', 'kmeans_cache_dir',
+                   'retrieval_streaming', 'spill_scores', 'retrieval_block_size']
+
+def config_hash(configs):
+  """Returns a hash of the model configs of an aligner"""
+  model_configs = {k:v for k, v in configs.items() if not k in RUNTIME_CONFIGS}
+  return hashlib.sha1(json.dumps(model_configs, sort_keys=True, default=str).encode()).hexdigest()
+
+def checkpoint_path(out_file):
+  return '{}_checkpoint.npz'.format(out_file)
+
+def save_checkpoint(out_file, aligner, i_iter):
+  """
+  Saves the means, P_ts and trg2src_counts of the aligner after iteration i_iter
+  in a single .npz file. The file is written under a temporary name and then
+  renamed, so an interrupted write leaves the previous checkpoint intact
+  """
+  path = checkpoint_path(out_file)
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    np.savez(f,
+             means=aligner.src_model.means,
+             P_ts=aligner.P_ts,
+             trg2src_counts=aligner.trg2src_counts,
+             i_iter=i_iter,
+             config_hash=aligner.config_hash)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+def load_checkpoint(out_file, aligner):
+  """
+  Restores the parameters of the aligner from the checkpoint of out_file, if any
+
+  Returns
+  -------
+  i_iter : int
+      The last iteration completed, -1 if there is no checkpoint
+  """
+  path = checkpoint_path(out_file)
+  if not os.path.isfile(path):
+    return -1
+  with np.load(path) as ckpt:
+    if str(ckpt['config_hash']) != aligner.config_hash:
+      raise ValueError('Checkpoint {} was saved with a different config'.format(path))
+    aligner.src_model.set_means(ckpt['means'])
+    aligner.P_ts = ckpt['P_ts']
+    aligner.trg2src_counts = ckpt['trg2src_counts']
+    return int(ckpt['i_iter'])
@@ -0,0 +1,155 @@
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+from aligner_utils import segment_reduce
+
+logger = logging.getLogger(__name__)
+
+def features_hash(blocks, K, **params):
+  """Returns a hash of the contents of the feature blocks, in order, of K and of the clustering params"""
+  h = hashlib.sha1(json.dumps(dict(K=K, **params), sort_keys=True).encode())
+  for block in blocks:
+    block = np.ascontiguousarray(block)
+    h.update('{}{}'.format(block.dtype.str, block.shape).encode())
+    h.update(block.data)
+  return h.hexdigest()
+
+def squared_distances(X, C, X_sq_norms=None):
+  """Returns the N x K squared distances between the rows of X and C as ||x||^2 - 2 x c^T + ||c||^2"""
+  if X_sq_norms is None:
+    X_sq_norms = np.sum(X**2, axis=1)
+  return np.maximum(X_sq_norms[:, np.newaxis] - 2 * X @ C.T + np.sum(C**2, axis=1), 0.)
+
+def reservoir_sample(blocks, n, rng):
+  """
+  Draws n rows uniformly without replacement from a stream of N_i x D blocks,
+  as the rows with the n smallest random keys, in O(n) memory
+  """
+  sample, keys = [], []
+  n_pending = 0
+  for block in blocks:
+    sample.append(np.asarray(block))
+    keys.append(rng.random_sample(len(block)))
+    n_pending += len(block)
+    if n_pending >= 2 * n:
+      sample, keys = _prune_sample(sample, keys, n)
+      n_pending = n
+  sample, _ = _prune_sample(sample, keys, n)
+  return sample[0]
+
+def _prune_sample(sample, keys, n):
+  sample, keys = np.concatenate(sample), np.concatenate(keys)
+  if len(keys) > n:
+    keep = np.argpartition(keys, n-1)[:n]
+    sample, keys = sample[keep], keys[keep]
+  return [sample], [keys]
+
+def kmeans_plusplus(X, K, rng):
+  """Greedy k-means++ seeding: each center is the best of 2+log(K) candidates drawn by D^2 sampling"""
+  n = len(X)
+  n_trials = 2 + int(np.log(K))
+  sq_norms = np.sum(X**2, axis=1)
+  centers = np.zeros((K, X.shape[1]))
+  centers[0] = X[rng.randint(n)]
+  min_dists = squared_distances(X, centers[:1], sq_norms)[:, 0]
+  for k in range(1, K):
+    total = np.sum(min_dists)
+    if total > 0:
+      cands = np.searchsorted(np.cumsum(min_dists), rng.random_sample(n_trials) * total)
+      cands = np.minimum(cands, n-1)
+    else:
+      cands = rng.randint(n, size=n_trials)
+    dists = np.minimum(min_dists[:, np.newaxis], squared_distances(X, X[cands], sq_norms))
+    best = np.argmin(np.sum(dists, axis=0))
+    centers[k] = X[cands[best]]
+    min_dists = dists[:, best]
+  return centers
+
+def iterate_batches(blocks, batch_size, rng):
+  """Yields batches of about batch_size rows made of whole blocks, in random order"""
+  batch, n_rows = [], 0
+  for i in rng.permutation(len(blocks)):
+    batch.append(np.asarray(blocks[i]))
+    n_rows += len(blocks[i])
+    if n_rows >= batch_size:
+      yield np.concatenate(batch)
+      batch, n_rows = [], 0
+  if n_rows > 0:
+    yield np.concatenate(batch)
+
+def minibatch_kmeans(blocks, centers, batch_size=4096, n_epochs=2, rng=np.random):
+  """
+  Mini-batch k-means (Sculley, 2010): every center moves toward the mean of
+  its batch points with a step size of 1 / (number of points assigned so far)
+  """
+  centers = centers.copy()
+  K = len(centers)
+  counts = np.zeros(K)
+  for i_epoch in range(n_epochs):
+    inertia = 0.
+    for batch in iterate_batches(blocks, batch_size, rng):
+      dists = squared_distances(batch, centers)
+      labels = np.argmin(dists, axis=1)
+      inertia += np.sum(dists[np.arange(len(batch)), labels])
+      n_k = np.bincount(labels, minlength=K)
+      offsets = np.append(0, np.cumsum(n_k))
+      sums = segment_reduce(np.add, batch[np.argsort(labels, kind='stable')], offsets, axis=0)
+      counts += n_k
+      nz = n_k > 0
+      centers[nz] += (sums[nz] - n_k[nz, np.newaxis] * centers[nz]) / counts[nz, np.newaxis]
+    logger.info('Mini-batch k-means epoch {}, inertia={:.5f}'.format(i_epoch, inertia))
+  return centers
+
+def kmeans_codebook(blocks, K,
+                    sample_size=100000,
+                    batch_size=4096,
+                    n_epochs=2,
+                    seed=0,
+                    cache_dir=None):
+  """
+  K-means codebook of the rows of a sequence of N_i x D feature blocks (e.g.,
+  the features of each image or utterance), seeded by k-means++ on a reservoir
+  sample and refined by mini-batch k-means. The distance computations are
+  GEMMs, run on all cores by BLAS.
+
+  Parameters
+  ----------
+  blocks : list of N_i x D arrays, or a single N x D array
+  K : int
+      The number of clusters
+  sample_size : int
+      The number of rows sampled for the k-means++ seeding
+  cache_dir : str
+      If given, the codebook is saved to and loaded from
+      {cache_dir}/kmeans_{hash}.npy, with the hash of the features and params
+
+  Returns
+  -------
+  centers : K x D array
+  """
+  if isinstance(blocks, np.ndarray):
+    blocks = [blocks[i:i+batch_size] for i in range(0, len(blocks), batch_size)]
+
+  cache_file = None
+  if cache_dir:
+    h = features_hash(blocks, K, sample_size=sample_size, batch_size=batch_size, n_epochs=n_epochs, seed=seed)
+    cache_file = os.path.join(cache_dir, 'kmeans_{}.npy'.format(h))
+    if os.path.isfile(cache_file):
+      logger.info('Load the k-means codebook from {}'.format(cache_file))
+      return np.load(cache_file)
+
+  rng = np.random.RandomState(seed)
+  sample = reservoir_sample(blocks, sample_size, rng)
+  if len(sample) < K:
+    raise ValueError('Cannot find {} clusters in {} feature vectors'.format(K, len(sample)))
+  centers = kmeans_plusplus(sample, K, rng)
+  centers = minibatch_kmeans(blocks, centers, batch_size, n_epochs, rng)
+
+  if cache_file:
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + '.tmp.npy'
+    np.save(tmp_file, centers)
+    os.replace(tmp_file, cache_file)
+  return centers
@@ -4,8 +4,22 @@
 import numpy as np
 import logging
 import os
+import sys
 import json
 from region_vgmm import *
+from aligner_utils import *
+from backends import get_backend
+from stepwise_em import StepwiseEM
+from blocked_retrieval import BlockedRetrieval
+from checkpoint import config_hash, save_checkpoint, load_checkpoint
+from async_validation import AsyncValidator
+from codebook import kmeans_codebook
+from feature_store import load_feature_store, load_soft_assignments
+from aligner_dataset import AlignerDataset
+from aligner_loaders import load_mscoco, load_flickr
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../utils'))
+from retrieval_metrics import matching_ranks, rank_metrics
+from alignment_io import AlignmentWriter
 import torch
 from NegativeSquare import NegativeSquare
 
@@ -14,34 +28,55 @@ EPS = 1e-30
 class ContinuousMixtureAligner(object):
   """An alignment model based on Brown et. al., 1993. capable of modeling continuous target sentences"""
   def __init__(self, source_features_train, target_features_train, configs):
+    """
+    Parameters
+    ----------
+    source_features_train : list of T x D arrays of region features, or an 
+        AlignerDataset of the training pairs, read on demand, with 
+        target_features_train None
+    target_features_train : list of target sentences
+    """
     self.Ks = configs.get('n_src_vocab', 80)
     self.Kt = configs.get('n_trg_vocab', 2001)
     self.use_null = configs.get('use_null', True)
+    self.max_val_in_flight = configs.get('max_val_in_flight', 1)
+    self.alignment_format = configs.get('alignment_format', '.jsonl')
+    self.config_hash = config_hash(configs)
     self.pretrained_model = configs.get('pretrained_vgmm_model', None)
     self.pretrained_translateprob = configs.get('pretrained_translateprob', None)
     var = configs.get('var', 160.) # XXX
     logger.info('n_src_vocab={}, n_trg_vocab={}'.format(self.Ks, self.Kt))
     self.alpha = configs.get('alpha', 0.)
-
-    self.src_vec_ids_train = []
-    start_index = 0
-    for ex, src_feat in enumerate(source_features_train):
-      if self.use_null:
+    self.batch_size = configs.get('batch_size', 64)
+    # Top-k retrieval with the score matrix computed block by block (see retrieve())
+    self.retrieval_streaming = configs.get('retrieval_streaming', False)
+    self.spill_scores = configs.get('spill_scores', False)
+    self.retrieval_block_size = configs.get('retrieval_block_size', 64)
+    self.backend = get_backend(configs.get('backend', 'numpy'), 
+                               configs.get('dtype', 'float64'), 
+                               eps=EPS, 
+                               n_threads=configs.get('n_threads', None))
+
+    if isinstance(source_features_train, AlignerDataset):
+      # NULL is prepended to the captions as they are read
+      dataset = source_features_train
+      source_features_train = dataset.source_store()
+      target_features_train = dataset.targets(null_id=self.Kt-1 if self.use_null else None)
+    elif self.use_null:
+      for ex in range(len(target_features_train)):
         target_features_train[ex] = [self.Kt-1]+target_features_train[ex]
-      src_vec_ids = []
-      for t in range(len(src_feat)):
-        src_vec_ids.append(start_index+t)
-      start_index += len(src_feat)
-      self.src_vec_ids_train.append(src_vec_ids)
 
     print('Pretrained VGMM file: {}'.format(self.pretrained_model))
     print('Pretrained translation probability file: {}'.format(self.pretrained_translateprob)) 
-    self.src_model = RegionVGMM(np.concatenate(source_features_train, axis=0),
+    # Region features of all the images as one contiguous array with offsets
+    if not isinstance(source_features_train, RaggedArray):
+      source_features_train = RaggedArray.from_list(source_features_train)
+    self.src_model = RegionVGMM(source_features_train,
                                 self.Ks,
                                 var=var,
-                                vec_ids=self.src_vec_ids_train,
-                                pretrained_model=self.pretrained_model)
-    self.src_feats = self.src_model.X
+                                pretrained_model=self.pretrained_model,
+                                cache_posteriors=configs.get('cache_posteriors', True),
+                                kmeans_cache_dir=configs.get('kmeans_cache_dir', None))
     self.trg_feats = target_features_train
     if self.pretrained_translateprob:
       self.P_ts = np.load(self.pretrained_translateprob)
@@ -54,11 +89,18 @@ class ContinuousMixtureAligner(object):
     # Update alignment counts
     log_probs = []
     self.trg2src_counts[:] = 0.
-    for i, (trg_feat, src_vec_ids) in enumerate(zip(self.trg_feats, self.src_vec_ids_train)):
-      src_feat = self.src_feats[src_vec_ids]
-      C_ts, log_prob_i = self.update_counts_i(i, src_feat, trg_feat)
-      self.trg2src_counts += C_ts
-      log_probs.append(log_prob_i)
+    if self.batch_size > 1:
+      n = len(self.trg_feats)
+      for start in range(0, n, self.batch_size):
+        C_ts, log_probs_b = self.update_counts_batch(list(range(start, min(start+self.batch_size, n))))
+        self.trg2src_counts += C_ts
+        log_probs.extend(log_probs_b.tolist())
+    else:
+      for i, trg_feat in enumerate(self.trg_feats):
+        src_feat = self.src_model.features(i)
+        C_ts, log_prob_i = self.update_counts_i(i, src_feat, trg_feat)
+        self.trg2src_counts += C_ts
+        log_probs.append(log_prob_i)
 
     self.P_ts = deepcopy(self.translate_prob())
     return np.mean(log_probs)
@@ -68,21 +110,83 @@ class ContinuousMixtureAligner(object):
     trg_sent = trg_feat
 
     V_src = to_one_hot(src_sent, self.Ks)
-    V_trg = to_one_hot(trg_sent, self.Kt)
-    P_a = V_trg @ self.P_ts @ V_src.T
+    P_a = gather_sent(trg_sent, self.P_ts) @ V_src.T
     
     log_prob = np.sum(np.log(np.maximum(np.mean(P_a, axis=0), EPS))) 
 
     C_a = P_a / np.maximum(np.sum(P_a, axis=0, keepdims=True), EPS) 
     V_src /= np.maximum(np.sum(V_src, axis=1, keepdims=True), EPS)
-    C_ts = np.sum(V_trg.T[:, :, np.newaxis] * np.sum(C_a[:, :, np.newaxis] * V_src[np.newaxis], axis=1)[np.newaxis], axis=1)
+    C_ts = scatter_sent(np.zeros((self.Kt, self.Ks)), trg_sent, C_a @ V_src)
     return C_ts, log_prob
 
+  def update_counts_batch(self, ex_ids):
+    """
+    Parameters
+    ----------
+    ex_ids : list of int
+        indices of the training examples in the block
+
+    Returns
+    -------
+    C_ts : Kt x Ks array of alignment counts summed over the block
+    log_probs : length B vector of per-example log likelihoods, same as update_counts_i
+    """
+    src_sents = [np.exp(log_prob_z) for log_prob_z in self.src_model.log_prob_zs(ex_ids, normalize=False)] # XXX
+    trg_sents = [self.trg_feats[i] for i in ex_ids]
+    return self.compute_counts_block(src_sents, trg_sents)
+
+  def compute_counts_block(self, src_sents, trg_sents):
+    """
+    Parameters
+    ----------
+    src_sents : list of T x Ks arrays of unnormalized concept probabilities of the source regions
+    trg_sents : list of target sentences, with NULL prepended if use_null 
+    """
+    # (B, T, Ks) zero-padded block
+    V_src, src_mask = to_padded_one_hot(src_sents, self.Ks)
+    # (B, L, Ks) zero-padded block of translation probability rows
+    if is_discrete(trg_sents[0]):
+      trg_ids, trg_mask = to_padded_index(trg_sents)
+      P_trg = gather_rows(self.P_ts, trg_ids) * trg_mask[:, :, np.newaxis]
+    else:
+      V_trg, trg_mask = to_padded_one_hot(trg_sents, self.Kt)
+      P_trg = V_trg @ self.P_ts
+    
+    # (B, L, Ks) expected counts of the target positions
+    W, log_probs = self.backend.mixture_counts(P_trg, V_src, trg_mask, src_mask)
+    C_ts = np.zeros((self.Kt, self.Ks))
+    if is_discrete(trg_sents[0]):
+      valid = trg_mask > 0
+      scatter_rows(C_ts, trg_ids[valid], W[valid])
+    else:
+      B, L, _ = V_trg.shape
+      C_ts += V_trg.reshape(B*L, self.Kt).T @ W.reshape(B*L, self.Ks)
+    return C_ts, log_probs
+
   def update_components(self):
+    means_new, counts = self.compute_component_stats(range(len(self.trg_feats)))
+    self.src_model.set_means(deepcopy(means_new / np.maximum(counts[:, np.newaxis], EPS)))
+
+  def compute_component_stats(self, ex_ids):
+    """
+    Returns
+    -------
+    means_new : Ks x D array of posterior-weighted sums of the region features in ex_ids
+    counts : length Ks vector of posterior counts of the regions in ex_ids
+    """
     means_new = np.zeros(self.src_model.means.shape)
     counts = np.zeros((self.Ks,))
-    for i, (trg_feat, src_feat) in enumerate(zip(self.trg_feats, self.src_feats)):
-      if len(trg_feat) == 0 or len(self.src_feats[i]) == 0:
+    if self.batch_size > 1:
+      ex_ids = list(ex_ids)
+      for start in range(0, len(ex_ids), self.batch_size):
+        means_b, counts_b = self.compute_component_stats_batch(ex_ids[start:start+self.batch_size])
+        means_new += means_b
+        counts += counts_b
+      return means_new, counts
+
+    for i in ex_ids:
+      trg_feat = self.trg_feats[i]
+      if len(trg_feat) == 0 or self.src_model.n_regions(i) == 0:
         continue 
       trg_sent = trg_feat
       prob_f_given_y = self.prob_s_given_tsent(trg_sent)
@@ -91,147 +195,212 @@ class ContinuousMixtureAligner(object):
       post_f /= np.maximum(np.sum(post_f, axis=1, keepdims=True), EPS)
   
       # Update target word counts of the target model
-      indices = self.src_vec_ids_train[i]
-     
-      means_new += np.sum(post_f[:, :, np.newaxis] * self.src_model.X[indices, np.newaxis], axis=0)
+      means_new += np.sum(post_f[:, :, np.newaxis] * self.src_model.features(i)[:, np.newaxis], axis=0)
       counts += np.sum(post_f, axis=0)
       # self.update_components_exact(i, ws=post_f, method='exact') 
-    self.src_model.means = deepcopy(means_new / np.maximum(counts[:, np.newaxis], EPS)) 
+    return means_new, counts
+
+  def compute_component_stats_batch(self, ex_ids):
+    """Batched version of compute_component_stats over the examples in ex_ids"""
+    return self.compute_component_stats_block([np.exp(log_prob_z) for log_prob_z in self.src_model.log_prob_zs(ex_ids)],
+                                              [self.trg_feats[i] for i in ex_ids],
+                                              [self.src_model.features(i) for i in ex_ids])
+
+  def compute_component_stats_block(self, src_sents, trg_sents, src_feats):
+    """
+    Parameters
+    ----------
+    src_sents : list of T x Ks arrays of concept posteriors of the source regions
+    trg_sents : list of target sentences, with NULL prepended if use_null
+    src_feats : list of T x D arrays of source region features
+    """
+    prob_f_given_x, src_mask = to_padded_one_hot(src_sents, self.Ks)
+    prob_f_given_y = np.asarray([self.prob_s_given_tsent(trg_sent) if len(trg_sent) > 0 else np.zeros(self.Ks) for trg_sent in trg_sents])
+    X, _ = to_padded_one_hot(src_feats, self.src_model.D)
+    return self.backend.component_stats(prob_f_given_x, prob_f_given_y, X, src_mask)
+
+  def trainStepwiseEM(self, batches, out_file, decay=0.7, save_every=100):
+    """
+    Stepwise (online) EM, which updates the parameters after every mini-batch
+
+    Parameters
+    ----------
+    batches : iterable of (source features, target features) mini-batches, 
+        e.g., iterate_minibatches(source_features, target_features, batch_size)
+        or AlignerDataset.iterate_blocks(batch_size)
+    decay : float
+        The step size of the k-th update is (k + 2)^(-decay), with 0.5 < decay <= 1
+    save_every : int
+        The number of updates between two saves of the parameters
+    """
+    stepwise_em = StepwiseEM(self, decay=decay)
+    for i_batch, (src_feats, trg_feats) in enumerate(batches):
+      log_prob = stepwise_em.update(src_feats, trg_feats)
+      logger.info('Batch {}, log likelihood={}'.format(i_batch, log_prob))
+      if (i_batch + 1) % save_every == 0:
+        print('Batch {}, log likelihood={}'.format(i_batch, log_prob))
+        np.save('{}_step{}_means.npy'.format(out_file, i_batch), self.src_model.means)
+        np.save('{}_step{}_transprob.npy'.format(out_file, i_batch), self.P_ts)
+    np.save('{}_final_means.npy'.format(out_file), self.src_model.means)
+    np.save('{}_final_transprob.npy'.format(out_file), self.P_ts)
      
   def trainEM(self, n_iter, 
               out_file, 
               source_features_val=None,
-              target_features_val=None):
-    for i_iter in range(n_iter):
+              target_features_val=None,
+              resume=False):
+    """
+    Parameters
+    ----------
+    source_features_val, target_features_val : lists of validation features, 
+        or an AlignerDataset of the validation pairs and None
+    """
+    if isinstance(source_features_val, AlignerDataset):
+      source_features_val, target_features_val = source_features_val.to_lists()
+    start_iter = self.resume_from_checkpoint(out_file) if resume else 0
+    validator = None
+    if source_features_val is not None and target_features_val is not None and self.max_val_in_flight > 0:
+      validator = AsyncValidator(source_features_val, target_features_val, self.max_val_in_flight)
+    for i_iter in range(start_iter, n_iter):
       log_prob = self.update_counts()
       self.update_components() # XXX
       print('Iteration {}, log likelihood={}'.format(i_iter, log_prob))
       logger.info('Iteration {}, log likelihood={}'.format(i_iter, log_prob))
+      save_checkpoint(out_file, self, i_iter)
       if (i_iter + 1) % 1 == 0:
-        with open('{}_{}_means.json'.format(out_file, i_iter), 'w') as fm,\
-             open('{}_{}_transprob.json'.format(out_file, i_iter), 'w') as ft:
-          json.dump(self.src_model.means.tolist(), fm, indent=4, sort_keys=True)
-          json.dump(self.P_ts.tolist(), ft, indent=4, sort_keys=True)
-         
         np.save('{}_{}_means.npy'.format(out_file, i_iter), self.src_model.means)
         np.save('{}_{}_transprob.npy'.format(out_file, i_iter), self.P_ts)
 
-        if source_features_val is not None and target_features_val is not None:
-          alignments, align_probs = self.align_sents(source_features_val, target_features_val, return_align_matrix=True)        
-          align_dicts = []
-          for src_feat, alignment, P_a in zip(source_features_val, alignments, align_probs):
-            src_sent = []
-            for i in range(src_feat.shape[0]):
-              log_prob_z = aligner.src_model.log_prob_z_given_X(src_feat[i])
-              src_sent.append(int(np.argmax(log_prob_z)))
-            align_dicts.append({'alignment': alignment.tolist(),
-                                'image_concepts': src_sent,
-                                'align_probs': P_a.tolist()})
-          with open('{}/alignment_{}.json'.format(args.exp_dir, i_iter), 'w') as f:
-            json.dump(align_dicts, f, indent=4, sort_keys=True)
-          
-          self.retrieve(source_features_val, target_features_val, out_file='{}_{}'.format(out_file, i_iter))
-
-
+        if validator is not None:
+          validator.submit(self, out_file, i_iter)
+        elif source_features_val is not None and target_features_val is not None:
+          self.validate(source_features_val, target_features_val, out_file, i_iter)
+
+    if validator is not None:
+      validator.close()
+
+  def validate(self, source_features_val, target_features_val, out_file, i_iter):
+    """Writes the alignments of the validation pairs and their retrieval results at iteration i_iter"""
+    alignments, align_probs = self.align_sents(source_features_val, target_features_val, return_align_matrix=True)        
+    with AlignmentWriter('{}/alignment_{}{}'.format(os.path.dirname(out_file) or '.', i_iter, self.alignment_format)) as writer:
+      for src_feat, alignment, P_a in zip(source_features_val, alignments, align_probs):
+        src_sent = np.argmax(self.src_model.log_prob_z_given_X(src_feat), axis=1)
+        writer.write({'alignment': alignment,
+                      'image_concepts': src_sent,
+                      'align_probs': P_a})
+    self.retrieve(source_features_val, target_features_val, out_file='{}_{}'.format(out_file, i_iter),
+                  block_size=self.retrieval_block_size,
+                  streaming=self.retrieval_streaming,
+                  spill_scores=self.spill_scores)
+
+  def resume_from_checkpoint(self, out_file):
+    """Restores the parameters from the checkpoint of out_file and returns the iteration to start from"""
+    i_iter = load_checkpoint(out_file, self)
+    if i_iter >= 0:
+      print('Resuming from iteration {}'.format(i_iter+1))
+      logger.info('Resuming from iteration {}'.format(i_iter+1))
+    return i_iter + 1
 
   def translate_prob(self):
     return (self.alpha / self.Ks + self.trg2src_counts) / np.maximum(self.alpha + np.sum(self.trg2src_counts, axis=-1, keepdims=True), EPS)
   
   def prob_s_given_tsent(self, trg_sent):
-    V_trg = to_one_hot(trg_sent, self.Kt)
-    return np.mean(V_trg @ self.P_ts, axis=0) 
+    return np.mean(gather_sent(trg_sent, self.P_ts), axis=0) 
     
   def align_sents(self, source_feats_test,
                   target_feats_test, 
                   score_type='max',
-                  return_align_matrix=False): 
+                  return_align_matrix=False,
+                  kbest=None): 
+    """
+    Returns
+    -------
+    alignments : list of length-T arrays of the most probable target position of each region
+    scores : array of the alignment scores of the pairs, or if return_align_matrix, 
+    align_probs : list of T x L arrays of alignment probabilities. If kbest is given,
+                  returns alignments, kbest_positions, kbest_probs instead, with T x kbest
+                  arrays of the best target positions of each region and their probabilities
+    """
+    src_sents = [np.exp(self.src_model.log_prob_z_given_X(src_feat)) for src_feat in source_feats_test]
+    return self.align_posteriors(src_sents, target_feats_test, score_type, return_align_matrix, kbest)
+
+  def align_posteriors(self, src_sents, trg_sents, score_type='max', return_align_matrix=False, kbest=None):
+    """Same as align_sents, with the T x Ks concept posteriors of the source sentences"""
     alignments = []
     scores = []
     align_probs = []
-    for src_feat, trg_feat in zip(source_feats_test, target_feats_test):
-      trg_sent = trg_feat
-      src_sent = [np.exp(self.src_model.log_prob_z_given_X(src_feat[i])) for i in range(len(src_feat))]
-      V_trg = to_one_hot(trg_sent, self.Kt)
-      V_src = to_one_hot(src_sent, self.Ks)
-      P_a = V_trg @ self.P_ts @ V_src.T
+    kbest_positions = []
+    for start in range(0, len(src_sents), self.batch_size):
+      P_a, src_mask, trg_mask = align_block(src_sents[start:start+self.batch_size], 
+                                            trg_sents[start:start+self.batch_size], 
+                                            self.P_ts)
+      # Padded target positions never win the argmax nor the top-k
+      P_a_valid = np.where(trg_mask[:, np.newaxis] > 0, P_a, -1.)
       if score_type == 'max':
-        scores.append(np.prod(np.max(P_a, axis=0)))
+        region_scores = np.max(P_a_valid, axis=2)
       elif score_type == 'mean':
-        scores.append(np.prod(np.mean(P_a, axis=0)))
+        region_scores = np.sum(P_a, axis=2) / np.maximum(np.sum(trg_mask, axis=1), 1)[:, np.newaxis]
       else:
         raise ValueError('Score type not implemented')
-      alignments.append(np.argmax(P_a, axis=0))
-      if return_align_matrix:
-        align_probs.append(P_a.T) 
-      # print('P_a.shape: {}'.format(P_a.shape))
-  
+      scores.extend(np.prod(np.where(src_mask > 0, region_scores, 1.), axis=1))
+      best = np.argmax(P_a_valid, axis=2)
+      if kbest is not None:
+        order = np.argsort(-P_a_valid, axis=2, kind='stable')[:, :, :kbest]
+        order_probs = np.take_along_axis(P_a, order, axis=2)
+
+      for b, (T, L) in enumerate(zip(np.sum(src_mask, axis=1).astype(int), np.sum(trg_mask, axis=1).astype(int))):
+        alignments.append(best[b, :T])
+        if kbest is not None:
+          kbest_positions.append(order[b, :T, :min(kbest, L)])
+          align_probs.append(order_probs[b, :T, :min(kbest, L)])
+        elif return_align_matrix:
+          align_probs.append(P_a[b, :T, :L])
+
+    if kbest is not None:
+      return alignments, kbest_positions, align_probs
     if return_align_matrix:
       return alignments, align_probs
     return alignments, np.asarray(scores)
 
-  def retrieve(self, source_features_test, target_features_test, out_file, kbest=10):
+  def retrieve(self, source_features_test, target_features_test, out_file, kbest=10, block_size=64,
+               streaming=False, spill_scores=False):
+    """
+    Image search and captioning over the test pairs. In streaming mode, the
+    scores are computed in blocks with only the top-k of each query kept
+    (see BlockedRetrieval) and, if spill_scores, written to a memory-mapped
+    out_file_scores.npy instead of being held in memory
+    """
     n = len(source_features_test)
     print(n)
-    scores = np.zeros((n, n))
-    for i_utt in range(n):
-      if self.use_null:
-        src_feats = [source_features_test[i_utt] for _ in range(n)] 
-        trg_feats = [[self.Kt - 1] + target_features_test[j_utt] for j_utt in range(n)]
-      else:
-        src_feats = [source_features_test[i_utt] for _ in range(n)] 
-        trg_feats = [target_features_test[j_utt] for j_utt in range(n)]
-      
-      _, scores[i_utt] = self.align_sents(src_feats, trg_feats, score_type='max') 
-
-    np.save('{}_scores.npy'.format(out_file), scores)
-    I_kbest = np.argsort(-scores, axis=1)[:, :kbest]
-    P_kbest = np.argsort(-scores, axis=0)[:kbest]
-    n = len(scores)
-    I_recall_at_1 = 0.
-    I_recall_at_5 = 0.
-    I_recall_at_10 = 0.
-    P_recall_at_1 = 0.
-    P_recall_at_5 = 0.
-    P_recall_at_10 = 0.
-
-    for i in range(n):
-      if I_kbest[i][0] == i:
-        I_recall_at_1 += 1
-      
-      for j in I_kbest[i][:5]:
-        if i == j:
-          I_recall_at_5 += 1
-       
-      for j in I_kbest[i][:10]:
-        if i == j:
-          I_recall_at_10 += 1
-      
-      if P_kbest[0][i] == i:
-        P_recall_at_1 += 1
-      
-      for j in P_kbest[:5, i]:
-        if i == j:
-          P_recall_at_5 += 1
-       
-      for j in P_kbest[:10, i]:
-        if i == j:
-          P_recall_at_10 += 1
-
-    I_recall_at_1 /= n
-    I_recall_at_5 /= n
-    I_recall_at_10 /= n
-    P_recall_at_1 /= n
-    P_recall_at_5 /= n
-    P_recall_at_10 /= n
-     
-    print('Image Search Recall@1: ', I_recall_at_1)
-    print('Image Search Recall@5: ', I_recall_at_5)
-    print('Image Search Recall@10: ', I_recall_at_10)
-    print('Captioning Recall@1: ', P_recall_at_1)
-    print('Captioning Recall@5: ', P_recall_at_5)
-    print('Captioning Recall@10: ', P_recall_at_10)
-    logger.info('Image Search Recall@1, 5, 10: {}, {}, {}'.format(I_recall_at_1, I_recall_at_5, I_recall_at_10))
-    logger.info('Captioning Recall@1, 5, 10: {}, {}, {}'.format(P_recall_at_1, P_recall_at_5, P_recall_at_10))
+    if self.use_null:
+      trg_feats = [np.asarray([self.Kt - 1] + list(trg_feat)) if is_discrete(trg_feat) else trg_feat for trg_feat in target_features_test]
+    else:
+      trg_feats = target_features_test
+    # Concept posteriors of every image and translation probabilities of
+    # every caption, computed once; the scores are log probabilities
+    src_probs = RaggedArray.from_list([np.exp(self.src_model.log_prob_z_given_X(src_feat)) for src_feat in source_features_test])
+    trg_probs = RaggedArray.from_list([gather_sent(trg_feat, self.P_ts) for trg_feat in trg_feats])
+    if streaming:
+      scores_file = '{}_scores.npy'.format(out_file) if spill_scores else None
+      retrieval = BlockedRetrieval(n, len(trg_probs), kbest=kbest, scores_file=scores_file)
+      retrieval.run(src_probs, trg_probs, score_type='max', block_size=block_size)
+      I_kbest = retrieval.trg_kbest()
+      P_kbest = retrieval.src_kbest().T
+      I_ranks, P_ranks = retrieval.trg_ranks, retrieval.src_ranks
+    else:
+      scores = log_max_product_scores(src_probs, trg_probs, score_type='max', block_size=block_size)
+      np.save('{}_scores.npy'.format(out_file), scores)
+      I_kbest = np.argsort(-scores, axis=1, kind='stable')[:, :kbest]
+      P_kbest = np.argsort(-scores, axis=0, kind='stable')[:kbest]
+      I_ranks, P_ranks = matching_ranks(scores, axis=1), matching_ranks(scores, axis=0)
+
+    for task, ranks in [('Image Search', I_ranks), ('Captioning', P_ranks)]:
+      metrics = rank_metrics(ranks)
+      for k in [1, 5, 10]:
+        print('{} Recall@{}: '.format(task, k), metrics['R@{}'.format(k)])
+      print('{} median rank, mean rank, mAP: {}, {}, {}'.format(task, metrics['median_rank'], metrics['mean_rank'], metrics['mAP']))
+      logger.info('{} Recall@1, 5, 10: {}, {}, {}'.format(task, metrics['R@1'], metrics['R@5'], metrics['R@10']))
+      logger.info('{} median rank, mean rank, mAP: {}, {}, {}'.format(task, metrics['median_rank'], metrics['mean_rank'], metrics['mAP']))
 
     fp1 = open(out_file + '_image_search.txt', 'w')
     fp2 = open(out_file + '_image_search.txt.readable', 'w')
@@ -254,123 +423,28 @@ class ContinuousMixtureAligner(object):
     self.trg2src_counts[:, k2] = self.trg2src_counts[:, k1]
     self.trg2src_counts[:, k1] = 0.
 
-  def print_alignment(self, out_file):
-    align_dicts = []
-    for i, (src_vec_ids, trg_feat) in enumerate(zip(self.src_vec_ids_train, self.trg_feats)):
-      src_feat = self.src_feats[src_vec_ids]
-      alignment = self.align_sents([src_feat], [trg_feat])[0][0]
-      src_sent = np.argmax(self.src_model.log_prob_z(i), axis=1)
-      align_dicts.append({'alignment': alignment.tolist(),
-                          'image_concepts': src_sent.tolist()})
-    with open(out_file, 'w') as f:
-      json.dump(align_dicts, f, indent=4, sort_keys=True)
+  def print_alignment(self, out_file, kbest=None):
+    """
+    Writes the alignments of the training pairs and, if kbest is given, the 
+    kbest most probable target positions of each region with their probabilities
+    """
+    log_prob_zs = self.src_model.log_prob_zs(range(len(self.trg_feats)))
+    src_sents = [np.exp(log_prob_z) for log_prob_z in log_prob_zs]
+    if kbest is not None:
+      alignments, kbest_positions, align_probs = self.align_posteriors(src_sents, self.trg_feats, kbest=kbest)
+    else:
+      alignments, _ = self.align_posteriors(src_sents, self.trg_feats)
+
+    with AlignmentWriter(out_file) as writer:
+      for i, alignment in enumerate(alignments):
+        align_dict = {'alignment': alignment,
+                      'image_concepts': np.argmax(log_prob_zs[i], axis=1)}
+        if kbest is not None:
+          align_dict['align_kbest'] = kbest_positions[i]
+          align_dict['align_kbest_probs'] = align_probs[i]
+        writer.write(align_dict)
     
       
-def to_one_hot(sent, K):
-  sent = np.asarray(sent)
-  if len(sent.shape) < 2:
-    es = np.eye(K)
-    sent = np.asarray([es[int(w)] if w < K else 1./K*np.ones(K) for w in sent])
-    return sent
-  else:
-    return sent
-
-def load_mscoco(path, max_n_boxes=10):
-  trg_feat_file_train = path['text_caption_file_train']
-  src_feat_file_train = path['image_feat_file_train']
-  trg_feat_file_test = path['text_caption_file_test_retrieval']
-  src_feat_file_test = path['image_feat_file_test']
-  
-  trg_feat_file_test_full = path['text_caption_file_test'] 
-  src_feat_file_test_full = path['image_feat_file_test']
-  retrieval_split = path['retrieval_split_file']
-  top_word_file = path.get('top_word_file', None)
-  word2idx_file = path['word_to_idx_file']
-  if not os.path.isfile(trg_feat_file_test):
-    with open(trg_feat_file_test_full, 'r') as f_tf,\
-         open(retrieval_split, 'r') as f_r,\
-         open(trg_feat_file_test, 'w') as f_tx:
-      splits = f_r.read().strip().split('\n')
-      trg_feat_test_full = f_tf.read().strip().split('\n') # XXX Choose the first out of five captions
-      trg_feat_test = [line for i, line in zip(splits, trg_feat_test_full) if i == '1'] # XXX
-      f_tx.write('\n'.join(trg_feat_test))
-  
-  if not os.path.isfile(word2idx_file):
-    with open(top_word_file, 'r') as f:
-      vocabs = f.read().strip().split('\n')
-    
-    word2idx = {w:i for i, w in enumerate(vocabs)}
-    with open(word2idx_file, 'w') as f:
-      json.dump(word2idx, f, indent=4, sort_keys=True)
-  else:
-    with open(word2idx_file, 'r') as f:
-      word2idx = json.load(f) 
-
-  with open(trg_feat_file_train, 'r') as f_tr,\
-       open(trg_feat_file_test, 'r') as f_tx:
-      trg_str_train = f_tr.read().strip().split('\n')
-      trg_str_test = f_tx.read().strip().split('\n')
-      trg_feats_train = [[word2idx[tw] for tw in trg_sent.split()] for trg_sent in trg_str_train] # XXX
-      trg_feats_test = [[word2idx[tw] for tw in trg_sent.split() if tw in word2idx] for trg_sent in trg_str_test] # XXX
-  
-  src_feat_npz_train = np.load(src_feat_file_train)
-  src_feat_npz_test = np.load(src_feat_file_test)
-  print('Number of training target sentences={}, number of training source sentences={}'.format(len(trg_feats_train), len(src_feat_npz_train)))
-  print('Number of test target sentences={}, number of test source sentences={}'.format(len(trg_feats_test), len(src_feat_npz_test)))
-
-  src_feats_train = [src_feat_npz_train[k][:max_n_boxes] for k in sorted(src_feat_npz_train, key=lambda x:int(x.split('_')[-1]))] # XXX
-  if len(src_feat_npz_test) > 1000:
-    with open(retrieval_split, 'r') as f: 
-      test_indices = [i for i, line in enumerate(f.read().strip().split('\n')) if line == '1']
-      src_feats_test = [src_feat_npz_test[k][:max_n_boxes] for k in sorted(src_feat_npz_test, key=lambda x:int(x.split('_')[-1])) if int(k.split('_')[-1]) in test_indices] # XXX
-  else:
-    src_feats_test = [src_feat_npz_test[k][:max_n_boxes] for k in sorted(src_feat_npz_test, key=lambda x:int(x.split('_')[-1]))] # XXX
-
-  return src_feats_train, trg_feats_train, src_feats_test, trg_feats_test
-
-def load_flickr(path):
-  trg_feat_file = path['text_caption_file']
-  src_feat_file = path['image_feat_file']
-  test_image_ids_file = path['test_image_ids_file']
-  word_to_idx_file = path['word_to_idx_file']
-  with open(word_to_idx_file, 'r') as f:
-    word2idx = json.load(f)
-
-  with open(test_image_ids_file, 'r') as f:
-    test_image_ids = ['_'.join(line.split('_')[0:2]) for ex, line in enumerate(f)] # XXX
-
-  # Load the captions
-  with open(trg_feat_file, 'r') as f:
-    trg_feats = []
-    for ex, line in enumerate(f):
-      # if ex >= 100: # XXX
-      #   break
-      trg_feats.append(line.split())
-
-  # Load the image features
-  src_feat_npz = np.load(src_feat_file)
-  image_ids = sorted(src_feat_npz, key=lambda x:int(x.split('_')[-1])) # XXX
-
-  # Split the features into train and test sets
-  src_feats_train = []
-  src_feats_test = []
-  trg_feats_train = []
-  trg_feats_test = []
-  for ex, img_id in enumerate(image_ids):
-    if img_id.split('.')[0] in test_image_ids:
-      if img_id.split('_')[2] == '1': # Select one caption per image for the test set (Pick the first caption for each image)
-        cur_trg_feat = [word2idx[w] for w in trg_feats[ex]] 
-        trg_feats_test.append(cur_trg_feat)
-        src_feats_test.append(src_feat_npz[img_id])
-    else:
-      cur_trg_feat = [word2idx[w] for w in trg_feats[ex]] 
-      trg_feats_train.append(cur_trg_feat)
-      src_feats_train.append(src_feat_npz[img_id])
-
-  print('Number of training target sentences={}, number of training source sentences={}'.format(len(trg_feats_train), len(src_feats_train)))
-  print('Number of test target sentences={}, number of test source sentences={}'.format(len(trg_feats_test), len(src_feats_test)))
-  return src_feats_train, trg_feats_train, src_feats_test, trg_feats_test 
-  
 def load_speechcoco(path):
   trg_feat_file_train = path['audio_feat_file_train']
   src_feat_file_train = path['image_feat_file_train']
@@ -379,31 +453,32 @@ def load_speechcoco(path):
   test_image_ids_file = path['retrieval_split_file']
   codebook_file = path['audio_codebook']
 
-  trg_feat_train_npz = np.load(trg_feat_file_train)
-  src_feat_train_npz = np.load(src_feat_file_train)
-  trg_feat_test_npz = np.load(trg_feat_file_test)
-  src_feat_test_npz = np.load(src_feat_file_test)  
+  codebook = np.load(codebook_file)
+
+  src_store_train = load_feature_store(src_feat_file_train, cache_dir=path.get('feature_cache_dir', None))
+  src_store_test = load_feature_store(src_feat_file_test, cache_dir=path.get('feature_cache_dir', None))
 
   with open(test_image_ids_file, 'r') as f:
     test_image_ids = [i for i, line in enumerate(f) if int(line)]
 
-  gaussian_softmax = NegativeSquare(torch.FloatTensor(codebook), 0.1)
-  trg_feats_train = [gaussian_softmax(torch.FloatTensor(trg_feat_train_npz[k]).unsqueeze(0), True).squeeze(0).cpu().detach().numpy() for k in sorted(trg_feat_train_npz, key=lambda x:int(x.split('_')[-1]))] # XXX
-  src_feats_train = [src_feat_train_npz[k] for k in sorted(src_feat_train_npz, key=lambda x:int(x.split('_')[-1]))] # XXX
-  trg_feats_test = [gaussian_softmax(torch.FloatTensor(trg_feat_test_npz[k]).unsqueeze(0), True).squeeze(0).cpu().detach().numpy() for i, k in enumerate(sorted(trg_feat_test_npz, key=lambda x:int(x.split('_')[-1]))) if i in test_image_ids] # XXX
-  src_feats_test = [src_feat_test_npz[k] for i, k in enumerate(sorted(src_feat_test_npz, key=lambda x:int(x.split('_')[-1]))) if i in test_image_ids] # XXX
-  print('Number of training target sentences={}, number of training source sentences={}'.format(len(trg_feats_train), len(src_feats_train)))
-  print('Number of test target sentences={}, number of test source sentences={}'.format(len(trg_feats_test), len(src_feats_test)))
-  return src_feats_train, trg_feats_train, src_feats_test, trg_feats_test 
+  # Soft assignments of the audio frames to the codebook, cached on disk
+  posterior_cache_dir = path.get('posterior_cache_dir', None)
+  trg_probs_train = load_soft_assignments(trg_feat_file_train, codebook, 0.1, cache_dir=posterior_cache_dir, feature_cache_dir=path.get('feature_cache_dir', None)) # XXX
+  trg_probs_test = load_soft_assignments(trg_feat_file_test, codebook, 0.1, cache_dir=posterior_cache_dir, feature_cache_dir=path.get('feature_cache_dir', None)) # XXX
+  train_set = AlignerDataset(src_store_train, trg_probs_train) # XXX
+  test_set = AlignerDataset(src_store_test, trg_probs_test, src_ids=test_image_ids, trg_ids=test_image_ids) # XXX
+  print('Number of training target sentences={}, number of training source sentences={}'.format(len(trg_probs_train), len(src_store_train)))
+  print('Number of test target sentences={}, number of test source sentences={}'.format(len(test_image_ids), len(test_image_ids)))
+  return train_set, test_set 
    
 if __name__ == '__main__':
   import argparse
-  from sklearn.cluster import KMeans
   
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('--exp_dir', '-e', type=str, default='./', help='Experimental directory')
   parser.add_argument('--dataset', '-d', type=str, default='mscoco', choices={'mscoco', 'mscoco2k', 'mscoco20k', 'flickr30k', 'speechcoco2k', 'speechcoco'}, help='Dataset used')
   parser.add_argument('--path_file', type=str, default=None)
+  parser.add_argument('--resume', action='store_true', help='Continue training from the latest checkpoint in the experimental directory')
   args = parser.parse_args()
   if not os.path.isdir(args.exp_dir):
     os.mkdir(args.exp_dir)
@@ -477,20 +552,18 @@ if __name__ == '__main__':
       json.dump(path, f, indent=4, sort_keys=True)
 
   if args.dataset == 'mscoco':       
-    src_feats_train, trg_feats_train, src_feats_test, trg_feats_test = load_mscoco(path)
+    train_set, test_set = load_mscoco(path)
     with open(path['word_to_idx_file'], 'r') as f:
       word_to_idx = json.load(f)
     Kt = len(word_to_idx)+1
     Ks = 80
     var = 160
-    trg_feats_train_dict = {'arr_{}'.format(ex):np.asarray(trg_feat) for ex, trg_feat in enumerate(trg_feats_train)}
-    trg_feats_test_dict = {'arr_{}'.format(ex):np.asarray(trg_feat) for ex, trg_feat in enumerate(trg_feats_test)}
   elif args.dataset == 'mscoco2k' or args.dataset == 'mscoco20k':
     Kt = Ks = 65
     var = 160
-    src_feats_train, trg_feats_train, src_feats_test, trg_feats_test = load_mscoco(path)
+    train_set, test_set = load_mscoco(path)
   elif args.dataset == 'flickr30k':
-    src_feats_train, trg_feats_train, src_feats_test, trg_feats_test = load_flickr(path)
+    train_set, test_set = load_flickr(path)
     Kt = 2001
     Ks = 600 # XXX
     var = 160
@@ -499,13 +572,12 @@ if __name__ == '__main__':
     Kt = Ks = 65
     if not 'audio_codebook' in path:
       trg_feat_file_train = path['audio_feat_file_train']
-      trg_feat_train_npz = np.load(trg_feat_file_train)
-      X = np.concatenate([trg_feat_train_npz[k] for k in sorted(trg_feat_train_npz, key=lambda x:int(x.split('_')[-1]))], axis=0) # XXX
-      codebook = KMeans(n_clusters=Kt).fit(X).cluster_centers_ 
+      trg_feats = list(load_feature_store(trg_feat_file_train, cache_dir=path.get('feature_cache_dir', None)))
+      codebook = kmeans_codebook(trg_feats, Kt, cache_dir=path.get('kmeans_cache_dir', args.exp_dir))
       np.save('{}/audio_codebook.npy'.format(args.exp_dir), codebook)
       path['audio_codebook'] = '{}/audio_codebook.npy'.format(args.exp_dir)
 
-    src_feats_train, trg_feats_train, src_feats_test, trg_feats_test = load_speechcoco(path)
+    train_set, test_set = load_speechcoco(path)
     var = 10.
   elif args.dataset == 'speechcoco':
     Kt = 1000 # XXX
@@ -513,41 +585,46 @@ if __name__ == '__main__':
     if not 'audio_codebook' in path:
       print('Start initializing audio codebook ...')
       trg_feat_file_train = path['audio_feat_file_train']
-      trg_feat_train_npz = np.load(trg_feat_file_train)
-      X = np.concatenate([trg_feat_train_npz[k] for k in sorted(trg_feat_train_npz, key=lambda x:int(x.split('_')[-1]))[::5]], axis=0) # XXX
-      codebook = KMeans(n_clusters=Kt).fit(X).cluster_centers_ 
+      trg_feats = list(load_feature_store(trg_feat_file_train, cache_dir=path.get('feature_cache_dir', None)))
+      codebook = kmeans_codebook(trg_feats, Kt, cache_dir=path.get('kmeans_cache_dir', args.exp_dir))
       np.save('{}/audio_codebook.npy'.format(args.exp_dir), codebook)
       path['audio_codebook'] = '{}/audio_codebook.npy'.format(args.exp_dir)
       print('Finish initializing the audio codebook!')
 
-    src_feats_train, trg_feats_train, src_feats_test, trg_feats_test = load_speechcoco(path)
+    train_set, test_set = load_speechcoco(path)
     var = 160.
 
   pretrained_vgmm_model = path.get('pretrained_vgmm_model', None)
   pretrained_translateprob = path.get('pretrained_translateprob', None)
     
-  aligner = ContinuousMixtureAligner(src_feats_train,
-                                     trg_feats_train,
+  src_feats_test, trg_feats_test = test_set.to_lists()
+  aligner = ContinuousMixtureAligner(train_set,
+                                     None,
                                      configs={'n_trg_vocab':Kt,
                                               'n_src_vocab':Ks,
                                               'var':var,
+                                              'batch_size':path.get('batch_size', 64),
+                                              'backend':path.get('backend', 'numpy'),
+                                              'dtype':path.get('dtype', 'float64'),
+                                              'n_threads':path.get('n_threads', None),
                                               'pretrained_vgmm_model':pretrained_vgmm_model,
+                                              'retrieval_streaming':path.get('retrieval_streaming', False),
+                                              'spill_scores':path.get('spill_scores', False),
+                                              'retrieval_block_size':path.get('retrieval_block_size', 64),
                                               'pretrained_translateprob':pretrained_translateprob})
-  aligner.trainEM(0, '{}/mixture'.format(args.exp_dir), source_features_val=src_feats_test, target_features_val=trg_feats_test) # XXX
-  aligner.retrieve(src_feats_test, trg_feats_test, '{}/retrieval'.format(args.exp_dir))
+  aligner.trainEM(0, '{}/mixture'.format(args.exp_dir), source_features_val=src_feats_test, target_features_val=trg_feats_test, resume=args.resume) # XXX
+  aligner.retrieve(src_feats_test, trg_feats_test, '{}/retrieval'.format(args.exp_dir),
+                   block_size=aligner.retrieval_block_size,
+                   streaming=aligner.retrieval_streaming,
+                   spill_scores=aligner.spill_scores)
 
-  aligner.print_alignment('{}/alignment.json'.format(args.exp_dir))
+  aligner.print_alignment('{}/alignment.jsonl'.format(args.exp_dir))
   alignments, align_probs = aligner.align_sents(src_feats_test, trg_feats_test)
-  align_dicts = []
-  for src_feat, alignment, P_a in zip(src_feats_test, alignments, align_probs):
-    src_sent = []
-    for i in range(src_feat.shape[0]):
-      log_prob_z = aligner.src_model.log_prob_z_given_X(src_feat[i])
-      src_sent.append(int(np.argmax(log_prob_z)))
-    align_dicts.append({'alignment': alignment.tolist(),
-                        'image_concepts': src_sent,
-                        'align_probs': P_a.tolist()})
-  with open('{}/alignment_test.json'.format(args.exp_dir), 'w') as f:
-    json.dump(align_dicts, f, indent=4, sort_keys=True)
+  with AlignmentWriter('{}/alignment_test.jsonl'.format(args.exp_dir)) as writer:
+    for src_feat, alignment, P_a in zip(src_feats_test, alignments, align_probs):
+      src_sent = np.argmax(aligner.src_model.log_prob_z_given_X(src_feat), axis=1)
+      writer.write({'alignment': alignment,
+                    'image_concepts': src_sent,
+                    'align_probs': P_a})
 
   # aligner.retrieve(src_feats_train, trg_feats_train, '{}/retrieval'.format(args.exp_dir))
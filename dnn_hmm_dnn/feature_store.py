@@ -0,0 +1,230 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import zipfile
+import torch
+from aligner_utils import RaggedArray
+from NegativeSquare import NegativeSquare
+
+logger = logging.getLogger(__name__)
+
+def npz_sort_key(k):
+  """The order of the features in the npz files, by the example index at the end of the keys"""
+  return int(k.split('_')[-1])
+
+class FeatureStore(RaggedArray):
+  """
+  Packed feature store: the features of every key as one contiguous array
+  ({prefix}_values.npy, float32 or float16), the offsets of the keys
+  ({prefix}_offsets.npy) and the keys in order ({prefix}_keys.npy), with a
+  key -> index map. The values are memory-mapped by load()
+
+  Parameters
+  ----------
+  values : N x D array
+  offsets : length n_keys+1 int64 array
+  keys : list of str
+  """
+  def __init__(self, values, offsets, keys):
+    super(FeatureStore, self).__init__(values, offsets)
+    self.keys = [str(k) for k in keys]
+    self.key2idx = {k:i for i, k in enumerate(self.keys)}
+
+  def save(self, prefix):
+    super(FeatureStore, self).save(prefix)
+    np.save('{}_keys.npy'.format(prefix), np.asarray(self.keys))
+
+  @classmethod
+  def load(cls, prefix, mmap_mode='r'):
+    return cls(np.load('{}_values.npy'.format(prefix), mmap_mode=mmap_mode),
+               np.load('{}_offsets.npy'.format(prefix)),
+               np.load('{}_keys.npy'.format(prefix)))
+
+  def get(self, key):
+    return self[self.key2idx[key]]
+
+def store_prefix(npz_file):
+  return os.path.splitext(npz_file)[0]
+
+def is_store(prefix):
+  # The keys are written last, so a store interrupted during conversion is not used
+  return os.path.isfile('{}_keys.npy'.format(prefix))
+
+def npz_meta(npz_file, dtype):
+  """The npz file (by path, size and modification time) and the dtype a store was converted from"""
+  stat = os.stat(npz_file)
+  return {'npz_file': os.path.realpath(npz_file),
+          'size': stat.st_size,
+          'mtime_ns': stat.st_mtime_ns,
+          'dtype': np.dtype(dtype).name}
+
+def is_current_store(prefix, npz_file, dtype):
+  """Whether the store of prefix was converted from the current npz_file, as recorded in {prefix}_meta.json"""
+  meta_file = '{}_meta.json'.format(prefix)
+  if not is_store(prefix) or not os.path.isfile(meta_file):
+    return False
+  with open(meta_file, 'r') as f:
+    return json.load(f) == npz_meta(npz_file, dtype)
+
+def read_npz_shapes(npz_file):
+  """Returns the shapes of the arrays of an npz file from their headers, without reading the arrays"""
+  shapes = {}
+  with zipfile.ZipFile(npz_file) as zf:
+    for name in zf.namelist():
+      with zf.open(name) as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+          shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+          shape, _, _ = np.lib.format.read_array_header_2_0(f)
+      shapes[name[:-len('.npy')] if name.endswith('.npy') else name] = shape
+  return shapes
+
+def npz_to_store(npz_file, prefix=None, dtype=np.float32, sort_key=npz_sort_key, mmap_mode='r'):
+  """
+  Converts an npz file of per-key L_i x D features to a FeatureStore, with the
+  keys sorted by sort_key. Every array is read once and written into the
+  memory-mapped values, so the features never have to fit in memory. The
+  npz file the store is converted from is recorded in {prefix}_meta.json
+
+  Returns
+  -------
+  store : FeatureStore, memory-mapped
+  """
+  prefix = prefix or store_prefix(npz_file)
+  meta_file = '{}_meta.json'.format(prefix)
+  if os.path.isfile(meta_file):
+    os.remove(meta_file)
+  shapes = read_npz_shapes(npz_file)
+  keys = sorted(shapes, key=sort_key)
+  feat_shape = next((shapes[k][1:] for k in keys if len(shapes[k]) > 1 and shapes[k][0] > 0), ())
+  offsets = np.zeros(len(keys)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum([shapes[k][0] if len(shapes[k]) > 0 else 0 for k in keys])
+
+  values = np.lib.format.open_memmap('{}_values.npy'.format(prefix), mode='w+', dtype=dtype, shape=(int(offsets[-1]),)+tuple(feat_shape))
+  with np.load(npz_file) as npz:
+    for i, k in enumerate(keys):
+      if offsets[i+1] > offsets[i]:
+        values[offsets[i]:offsets[i+1]] = npz[k].reshape((-1,)+tuple(feat_shape))
+  values.flush()
+  del values
+  np.save('{}_offsets.npy'.format(prefix), offsets)
+  np.save('{}_keys.npy'.format(prefix), np.asarray(keys))
+  # The meta file is written last, so an interrupted conversion is never used
+  with open(meta_file, 'w') as f:
+    json.dump(npz_meta(npz_file, dtype), f, indent=4, sort_keys=True)
+  logger.info('Converted {} with {} keys to {}'.format(npz_file, len(keys), prefix))
+  return FeatureStore.load(prefix, mmap_mode=mmap_mode)
+
+def load_feature_store(npz_file, dtype=np.float32, mmap_mode='c', cache_dir=None):
+  """
+  Memory-maps the FeatureStore converted from npz_file, converting it on 
+  first use and again when npz_file changes. npz_file may also be the prefix
+  of a store. The default copy-on-write mapping gives writable arrays (e.g.,
+  for torch) that never modify the store
+
+  Parameters
+  ----------
+  cache_dir : str
+      The directory of the store, that of npz_file by default. If the store
+      cannot be written there, it is converted into a temporary directory
+  """
+  if not os.path.isfile(npz_file):
+    return FeatureStore.load(store_prefix(npz_file), mmap_mode=mmap_mode)
+  prefix = store_prefix(npz_file)
+  if cache_dir:
+    prefix = os.path.join(cache_dir, os.path.basename(prefix))
+  if is_current_store(prefix, npz_file, dtype):
+    return FeatureStore.load(prefix, mmap_mode=mmap_mode)
+
+  print('Converting {} to a packed feature store ...'.format(npz_file))
+  try:
+    if cache_dir:
+      os.makedirs(cache_dir, exist_ok=True)
+    return npz_to_store(npz_file, prefix, dtype=dtype, mmap_mode=mmap_mode)
+  except OSError as e:
+    prefix = os.path.join(tempfile.mkdtemp(), os.path.basename(prefix))
+    logger.info('Cannot write the feature store of {} ({}), converting it to {}'.format(npz_file, e, prefix))
+    return npz_to_store(npz_file, prefix, dtype=dtype, mmap_mode=mmap_mode)
+
+def soft_assignment_hash(feat_file, codebook, precision):
+  """Hashes the feature file (by path, size and modification time), the codebook and the precision"""
+  stat = os.stat(feat_file)
+  h = hashlib.sha1(json.dumps({'feat_file':os.path.realpath(feat_file),
+                               'size':stat.st_size,
+                               'mtime_ns':stat.st_mtime_ns,
+                               'precision':float(precision)}, sort_keys=True).encode())
+  h.update(np.ascontiguousarray(codebook, dtype=np.float32).data)
+  return h.hexdigest()
+
+def write_soft_assignments(prefix, feats, codebook, precision, chunk_size=4096):
+  """Writes the soft assignments of the features feats as the store of prefix (see load_soft_assignments())"""
+  K = codebook.shape[0]
+  lens = np.diff(feats.offsets)
+  offsets = np.zeros(len(feats)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum(np.maximum(lens, 1))
+  # Row of each frame in the posteriors, after the zero rows of the empty examples before it
+  shifts = np.repeat(np.cumsum(lens == 0) - (lens == 0), lens)
+
+  values = np.lib.format.open_memmap('{}_values.npy'.format(prefix), mode='w+', dtype=np.float32, shape=(int(offsets[-1]), K))
+  gaussian_softmax = NegativeSquare(torch.FloatTensor(codebook), precision)
+  with torch.no_grad():
+    for t in range(0, len(feats.values), chunk_size):
+      x = torch.FloatTensor(np.asarray(feats.values[t:t+chunk_size], dtype=np.float32)).unsqueeze(0)
+      rows = np.arange(t, t+x.size(1)) + shifts[t:t+chunk_size]
+      values[rows] = gaussian_softmax(x, True).squeeze(0).cpu().numpy()
+  values.flush()
+  del values
+  np.save('{}_offsets.npy'.format(prefix), offsets)
+  np.save('{}_keys.npy'.format(prefix), np.asarray(feats.keys))
+
+def load_soft_assignments(feat_file, codebook, precision, cache_dir=None, chunk_size=4096, feature_cache_dir=None):
+  """
+  Soft assignments softmax(-precision * ||x - mu_k||^2) of the frames of every
+  example of feat_file to the codebook, as a FeatureStore of T_i x K
+  posteriors, with a single row of zeros for the empty examples. The
+  posteriors are computed once, chunk_size frames at a time, cached as
+  {cache_dir}/{feature file name}_posteriors_{hash} and memory-mapped on
+  later calls
+
+  Parameters
+  ----------
+  feat_file : str
+      npz file (or feature store) of the T_i x D features
+  codebook : K x D array
+  cache_dir : str
+      The directory of the cache, that of feat_file by default
+  feature_cache_dir : str
+      The cache_dir of the feature store of feat_file, see load_feature_store()
+  """
+  cache_dir = cache_dir or os.path.dirname(feat_file) or '.'
+  prefix = os.path.join(cache_dir, '{}_posteriors_{}'.format(os.path.basename(store_prefix(feat_file)),
+                                                              soft_assignment_hash(feat_file, codebook, precision)[:16]))
+  if is_store(prefix):
+    return FeatureStore.load(prefix, mmap_mode='c')
+
+  feats = load_feature_store(feat_file, cache_dir=feature_cache_dir)
+  lens = np.diff(feats.offsets)
+  n_empty = int(np.sum(lens == 0))
+  if n_empty > 0:
+    print('Warning: {} empty captions'.format(n_empty))
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    write_soft_assignments(prefix, feats, codebook, precision, chunk_size)
+  except OSError as e:
+    prefix = os.path.join(tempfile.mkdtemp(), os.path.basename(prefix))
+    logger.info('Cannot write the soft assignments of {} ({}), writing them to {}'.format(feat_file, e, prefix))
+    write_soft_assignments(prefix, feats, codebook, precision, chunk_size)
+  return FeatureStore.load(prefix, mmap_mode='c')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('NPZ_FILE', type=str, help='npz file of per-key features')
+  parser.add_argument('--prefix', type=str, default=None, help='Prefix of the store files, the npz path without extension by default')
+  parser.add_argument('--dtype', choices={'float32', 'float16'}, default='float32')
+  args = parser.parse_args()
+  npz_to_store(args.NPZ_FILE, args.prefix, dtype=np.dtype(args.dtype))
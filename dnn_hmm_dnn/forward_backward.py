@@ -0,0 +1,159 @@
+import numpy as np
+
+EPS = 1e-15
+class StayJumpTransitions(object):
+  """
+  Transition probabilities of the form 
+  
+    A[l', l] = stay[l'] if l == l' else jump[l'] * weights[l],
+
+  e.g., uniform transitions over L positions with stay = jump = 1/L and 
+  weights = 1. The jump mass into l is then the total jump mass minus that 
+  of l itself, so the products with A cost O(L) instead of O(L^2). The 
+  parameters are ... x L arrays, with zeros for padded positions.
+  """
+  def __init__(self, stay, jump, weights):
+    self.stay = stay
+    self.jump = jump
+    self.weights = weights
+
+  @classmethod
+  def uniform(cls, mask):
+    """Uniform transitions among the valid positions of a ... x L mask"""
+    probs = mask / np.maximum(np.sum(mask, axis=-1, keepdims=True), 1)
+    return cls(probs, probs, mask)
+
+  def diag(self):
+    return self.stay
+
+  def jump_forward(self, mass):
+    """Returns sum_{l' != l} A[l', l] mass[l']"""
+    jump_mass = self.jump * mass
+    return self.weights * (np.sum(jump_mass, axis=-1, keepdims=True) - jump_mass)
+
+  def jump_backward(self, mass):
+    """Returns sum_{l' != l} A[l, l'] mass[l']"""
+    weighted_mass = self.weights * mass
+    return self.jump * (np.sum(weighted_mass, axis=-1, keepdims=True) - weighted_mass)
+
+class DenseTransitions(object):
+  """Arbitrary ... x L x L transition probabilities with the interface of StayJumpTransitions"""
+  def __init__(self, A):
+    self.A = A
+    self.A_offdiag = A * (1. - np.eye(A.shape[-1]))
+
+  def diag(self):
+    return np.diagonal(self.A, axis1=-2, axis2=-1)
+
+  def jump_forward(self, mass):
+    return np.einsum('...ij,...i->...j', self.A_offdiag, mass)
+
+  def jump_backward(self, mass):
+    return np.einsum('...ij,...j->...i', self.A_offdiag, mass)
+
+class BatchForwardBackward(object):
+  """
+  Forward-backward algorithm of the fully continuous mixture aligner over a
+  zero-padded batch of sentence pairs. The state of the lattice is a (target
+  position l, codebook entry k) pair and the emission probabilities can either
+  be shared across target positions, of shape B x T x 1 x K, or specific to
+  each position, of shape B x T x L x K (e.g., K = 1 for discrete target
+  sentences, where the codebook entry of each position is fixed).
+
+  The buffers are kept between calls and only reallocated when a larger batch
+  comes in, so the arrays returned are overwritten by the next call.
+  """
+  def __init__(self, dtype=np.float64):
+    self.dtype = dtype
+    self.buffers = {}
+
+  def buffer(self, name, shape):
+    size = int(np.prod(shape))
+    if not name in self.buffers or self.buffers[name].size < size:
+      self.buffers[name] = np.empty(size, dtype=self.dtype)
+    return self.buffers[name][:size].reshape(shape)
+
+  def compute_forward_probs(self, probs, trg_sent, init, A, src_mask):
+    """
+    Parameters
+    ----------
+    probs : B x T x (1 or L) x K array of emission probabilities p(x_t|z_t=k)
+    trg_sent : B x L x K array of probabilities p(z=k|y_l), zero for padded positions
+    init : B x L array of initial probabilities, zero for padded positions
+    A : StayJumpTransitions, DenseTransitions or B x L x L array of transition 
+        probabilities, zero for padded positions
+    src_mask : B x T array, 1 for valid source positions and 0 for padding
+
+    Returns
+    -------
+    forward_probs : B x T x L x K array of scaled forward probabilities
+    scales : B x T array of scale factors, 1 for padded source positions
+    """
+    B, T = src_mask.shape
+    L = trg_sent.shape[1]
+    K = max(probs.shape[-1], trg_sent.shape[-1])
+    forward_probs = self.buffer('forward_probs', (B, T, L, K))
+    scales = self.buffer('scales', (B, T))
+    if isinstance(A, np.ndarray):
+      A = DenseTransitions(A)
+    A_diag = A.diag()[:, :, np.newaxis]
+
+    np.multiply(init[:, :, np.newaxis] * trg_sent, probs[:, 0], out=forward_probs[:, 0])
+    for t in range(T):
+      if t > 0:
+        np.multiply(A_diag * forward_probs[:, t-1], probs[:, t], out=forward_probs[:, t])
+        jump_probs = A.jump_forward(np.sum(forward_probs[:, t-1], axis=-1))
+        forward_probs[:, t] += jump_probs[:, :, np.newaxis] * trg_sent * probs[:, t]
+      scales[:, t] = np.where(src_mask[:, t] > 0, np.sum(forward_probs[:, t], axis=(1, 2)), 1.)
+      forward_probs[:, t] /= np.maximum(scales[:, t], EPS)[:, np.newaxis, np.newaxis]
+    return forward_probs, scales
+
+  def compute_backward_probs(self, probs, trg_sent, A, scales, src_mask):
+    """
+    Returns
+    -------
+    backward_probs : B x T x L x K array of scaled backward probabilities
+    """
+    B, T = src_mask.shape
+    L = trg_sent.shape[1]
+    K = max(probs.shape[-1], trg_sent.shape[-1])
+    backward_probs = self.buffer('backward_probs', (B, T, L, K))
+    if isinstance(A, np.ndarray):
+      A = DenseTransitions(A)
+    A_diag = A.diag()[:, :, np.newaxis]
+
+    backward_probs[:, T-1] = 1.
+    for t in range(T-1, 0, -1):
+      emit_probs = backward_probs[:, t] * probs[:, t]
+      np.multiply(A_diag, emit_probs, out=backward_probs[:, t-1])
+      jump_probs = A.jump_backward(np.sum(emit_probs * trg_sent, axis=-1))
+      backward_probs[:, t-1] += jump_probs[:, :, np.newaxis]
+      backward_probs[:, t-1] /= np.maximum(scales[:, t], EPS)[:, np.newaxis, np.newaxis]
+      # Position t-1 is the last one of the examples of length t
+      backward_probs[src_mask[:, t] == 0, t-1] = 1.
+    return backward_probs
+
+  def compute_posteriors(self, forward_probs, backward_probs, src_mask):
+    """
+    Returns
+    -------
+    post_probs : B x T x L x K array of state posteriors, zero for padded source positions
+    """
+    post_probs = self.buffer('post_probs', forward_probs.shape)
+    np.multiply(forward_probs, backward_probs, out=post_probs)
+    norm_factor = np.sum(post_probs, axis=(2, 3))
+    post_probs *= (src_mask / np.maximum(norm_factor, EPS))[:, :, np.newaxis, np.newaxis]
+    return post_probs
+
+  def run(self, probs, trg_sent, init, A, src_mask):
+    """
+    Returns
+    -------
+    post_probs : B x T x L x K array of state posteriors
+    log_probs : length B vector of log likelihoods
+    """
+    forward_probs, scales = self.compute_forward_probs(probs, trg_sent, init, A, src_mask)
+    backward_probs = self.compute_backward_probs(probs, trg_sent, A, scales, src_mask)
+    post_probs = self.compute_posteriors(forward_probs, backward_probs, src_mask)
+    log_probs = np.sum(np.log(np.maximum(scales, EPS)) * src_mask, axis=1)
+    return post_probs, log_probs
@@ -1,8 +1,9 @@
 import numpy as np
-from sklearn.cluster import KMeans
 from sklearn.mixture import BayesianGaussianMixture
 from scipy.special import logsumexp
 from copy import deepcopy
+from aligner_utils import RaggedArray
+from codebook import kmeans_codebook
 
 class RegionVGMM(object):
   """
@@ -10,21 +11,45 @@ class RegionVGMM(object):
 
   Parameters
   ----------
+  X : RaggedArray or N x D array
+      The region features, either as a store of the features of every image 
+      (one contiguous N x D array, possibly an np.memmap, and the offsets of 
+      the images) or as a single array with the region ids of the images in vec_ids 
   K : int
       The number of mixture components
+  vec_ids : list of lists of int
+      The contiguous region ids of each image, if X is an array
+  cache_posteriors : bool
+      Whether to keep the unnormalized log p(z|x) of the regions in an N x K 
+      buffer, filled on first access and reused until the means change
+  kmeans_cache_dir : str
+      If given, the directory where the k-means initialization of the means
+      is cached (see kmeans_codebook())
   """
   def __init__(self, X, K,
                assignments='kmeans',
                var=1., lr=0.1,
                vec_ids=None,
-               pretrained_model=None):
+               pretrained_model=None,
+               cache_posteriors=False,
+               kmeans_cache_dir=None):
+    if isinstance(X, RaggedArray):
+      self.offsets = X.offsets
+      X = X.values
+    elif vec_ids is not None:
+      self.offsets = np.zeros(len(vec_ids)+1, dtype=np.int64)
+      self.offsets[1:] = np.cumsum([len(ids) for ids in vec_ids])
+    else:
+      self.offsets = np.asarray([0, X.shape[0]], dtype=np.int64)
     self.K_max = K
     self.D = X.shape[-1]
     self.means = np.zeros((K, self.D))
     self.lr = lr
     self.X = X
     self.var = var
-    self.vec_ids = vec_ids # TODO Make this nonempty by default
+    self.cache_posteriors = cache_posteriors
+    self.kmeans_cache_dir = kmeans_cache_dir
+    self.init_cache()
     if pretrained_model is None:
       self.setup_components()
     else:
@@ -32,13 +57,17 @@ class RegionVGMM(object):
 
   def setup_components(self, assignments='kmeans'): 
     if isinstance(assignments, str) and assignments == 'kmeans':
-      # keep = list(range(self.X.shape[0])) [
-      keep = [i_ex*50+i_region for i_ex in range(int(self.X.shape[0]/50)) for i_region in range(10)] # Only select a subset of examples for KMeans clustering
-      keep = np.asarray(keep)
-      self.means = KMeans(n_clusters=self.K_max).fit(self.X[keep]).cluster_centers_ # BayesianGaussianMixture(n_components=self.K_max, covariance_type='diag', weight_concentration_prior=1000., max_iter=1000).fit(self.X[keep]).means_ # XXX 
+      self.means = kmeans_codebook(self.X, self.K_max, cache_dir=self.kmeans_cache_dir) # BayesianGaussianMixture(n_components=self.K_max, covariance_type='diag', weight_concentration_prior=1000., max_iter=1000).fit(self.X[keep]).means_ # XXX 
     else:
       raise NotImplementedError
  
+  def features(self, i):
+    """Returns the L x D region features of the i-th image as a view of X"""
+    return self.X[self.offsets[i]:self.offsets[i+1]]
+
+  def n_regions(self, i):
+    return int(self.offsets[i+1] - self.offsets[i])
+
   def log_prob_z(self, i, normalize=True):
     """
     Parameters
@@ -48,19 +77,90 @@ class RegionVGMM(object):
     
     Returns
     -------
-    log_prob_z : length K vector 
+    log_prob_z : L x K array
              [[p(z_i=k|y_i) for k in range(K)] for i in range(L)]
     """
-    log_prob_zs = []
-    for j in self.vec_ids[i]:
-      log_prob_z = self.log_prob_z_given_X(self.X[j], normalize=normalize) 
-      log_prob_zs.append(log_prob_z)
-    return np.asarray(log_prob_zs)
+    return self.log_prob_zs([i], normalize=normalize)[0]
+
+  def log_prob_z_batch(self, indices, normalize=True):
+    """
+    Parameters
+    ----------
+    indices : int array or slice
+        rows of X of a batch of regions, e.g., from region_indices()
+
+    Returns
+    -------
+    log_prob_z : N x K array of log p(z_j=k|y_j) for the N regions
+    """
+    return self.log_prob_z_given_X(self.X[indices], normalize=normalize)
+
+  def log_prob_zs(self, ex_ids, normalize=True):
+    """Returns [log_prob_z(i) for i in ex_ids] computed in a single batch"""
+    lens = [self.n_regions(i) for i in ex_ids]
+    if self.cache_posteriors:
+      log_prob_z = self.cached_log_prob_z(ex_ids)
+      if normalize:
+        log_prob_z -= logsumexp(log_prob_z, axis=-1, keepdims=True)
+    else:
+      log_prob_z = self.log_prob_z_batch(self.region_indices(ex_ids), normalize=normalize)
+    return np.split(log_prob_z, np.cumsum(lens)[:-1])
+
+  def init_cache(self):
+    self.log_prob_z_cache = None
+    self.cached = np.zeros(len(self.offsets)-1, dtype=bool)
+
+  def invalidate_cache(self):
+    """Marks the cached posteriors as stale; to be called whenever the means change"""
+    self.cached[:] = False
+
+  def set_means(self, means):
+    self.means = means
+    self.invalidate_cache()
+
+  def snapshot(self):
+    """Returns a copy of the model with the current means and no region features"""
+    snapshot = RegionVGMM.__new__(RegionVGMM)
+    snapshot.__dict__.update({k:v for k, v in self.__dict__.items() if not k in ['X', 'offsets', 'log_prob_z_cache', 'cached']})
+    snapshot.means = self.means.copy()
+    snapshot.X = np.zeros((0, self.D), dtype=self.X.dtype)
+    snapshot.offsets = np.zeros(1, dtype=np.int64)
+    snapshot.init_cache()
+    return snapshot
+
+  def cached_log_prob_z(self, ex_ids):
+    """Returns a copy of the unnormalized log p(z|x) of the regions of ex_ids, computing those not in the cache"""
+    if self.log_prob_z_cache is None:
+      self.log_prob_z_cache = np.empty((self.X.shape[0], self.K_max), dtype=self.means.dtype)
+    ex_ids = np.asarray(ex_ids, dtype=np.int64)
+    missing = np.unique(ex_ids[~self.cached[ex_ids]])
+    if len(missing) > 0:
+      indices = self.region_indices(missing)
+      self.log_prob_z_cache[indices] = self.log_prob_z_batch(indices, normalize=False)
+      self.cached[missing] = True
+    return self.log_prob_z_cache[self.region_indices(ex_ids)]
+
+  def region_indices(self, ex_ids):
+    """Returns the rows of X of the regions of the images ex_ids"""
+    ranges = [np.arange(self.offsets[i], self.offsets[i+1]) for i in ex_ids]
+    return np.concatenate(ranges) if len(ranges) > 0 else np.zeros(0, dtype=np.int64)
 
   def log_prob_z_given_X(self, X, normalize=True):
-    log_prob_z = - np.sum((X - self.means) ** 2, axis=1) / self.var
+    """
+    Parameters
+    ----------
+    X : D vector or N x D array of region features
+
+    Returns
+    -------
+    log_prob_z : K vector or N x K array of log p(z=k|x), with the squared 
+                 distances expanded as ||x||^2 - 2 x mu^T + ||mu||^2
+    """
+    X = np.asarray(X, dtype=self.means.dtype)
+    sq_dists = np.sum(X ** 2, axis=-1, keepdims=True) - 2 * X @ self.means.T + np.sum(self.means ** 2, axis=1)
+    log_prob_z = - np.maximum(sq_dists, 0) / self.var
     if normalize:
-      log_prob_z -= logsumexp(log_prob_z)
+      log_prob_z -= logsumexp(log_prob_z, axis=-1, keepdims=True)
     return log_prob_z
 
   def log_post_pred(self, i):
@@ -75,20 +175,16 @@ class RegionVGMM(object):
     log_post_pred : length K vector
              [log (1/L \sum_{j=1}^L p(z_j^i=k|y_j^i)) for k in range(K)]
     """
-    L = len(self.vec_ids[i])
-    log_post_preds = []
-    for j in self.vec_ids[i]:    
-      log_post_pred_j = - np.sum((self.X[j] - self.means) ** 2, axis=1) / self.var
-      log_post_pred_j -= logsumexp(log_post_pred_j)
-      log_post_preds.append(log_post_pred_j)
-   
-    return logsumexp(np.asarray(log_post_preds), axis=0) - np.log(L)
+    L = self.n_regions(i)
+    return logsumexp(self.log_prob_z(i), axis=0) - np.log(L)
 
   def update_components(self, indices, ws):
     assert len(indices) == ws.shape[0]
     vs = self.X[indices]
     self.means += self.lr * np.dot(np.transpose(ws), vs)
+    self.invalidate_cache()
    
   def swap_clusters(self, k1, k2):
-    tmp = deepcopy(self.means[k2])
-    self.means[k2] = self.means[k1]
+    means = deepcopy(self.means)
+    means[[k1, k2]] = self.means[[k2, k1]]
+    self.set_means(means)
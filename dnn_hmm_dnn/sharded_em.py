@@ -0,0 +1,154 @@
+import numpy as np
+import logging
+import multiprocessing as mp
+from region_vgmm import RegionVGMM
+from aligner_utils import RaggedArray, SparsePosteriorsArray
+
+logger = logging.getLogger(__name__)
+EPS = 1e-15
+_worker = {}
+
+class ShardedEM(object):
+  """
+  Computes the E-step statistics of an aligner over fixed shards of the 
+  training set in a process pool. The region features, their offsets and
+  the target features are copied once into shared memory (mp.RawArray)
+  passed to the workers at their start, except for the memory-mapped 
+  region features, which each worker maps again from their file; only P_ts
+  and the means are sent to the workers at each step, and the partial
+  statistics are reduced in shard order. The workers are spawned rather 
+  than forked, since forking after the BLAS/OpenMP thread pools of torch
+  and numpy are started can deadlock.
+
+  Parameters
+  ----------
+  aligner : FullyContinuousMixtureAligner
+  n_workers : int
+      The number of worker processes
+  n_shards : int
+      The number of shards, n_workers by default
+  """
+  def __init__(self, aligner, n_workers, n_shards=None):
+    self.aligner = aligner
+    n_ex = len(aligner.trg_feats)
+    n_shards = n_shards if n_shards else n_workers
+    self.shards = [ids for ids in np.array_split(np.arange(n_ex), n_shards) if len(ids) > 0]
+
+    arrays = {'X': aligner.src_model.X,
+              'src_offsets': aligner.src_model.offsets}
+    if isinstance(aligner.trg_feats, SparsePosteriorsArray):
+      arrays.update({'trg_indices': aligner.trg_feats.indices,
+                     'trg_weights': aligner.trg_feats.weights,
+                     'trg_offsets': aligner.trg_feats.offsets})
+    else:
+      trg_dtype = np.int64 if aligner.trg_embedding_dim == 1 else np.float64
+      trg_feats = RaggedArray.from_list(aligner.trg_feats, dtype=trg_dtype)
+      arrays.update({'trg_feats': trg_feats.values,
+                     'trg_offsets': trg_feats.offsets})
+    specs = {}
+    for name, arr in arrays.items():
+      specs[name] = memmap_spec(arr)
+      if specs[name] is None:
+        arr = np.ascontiguousarray(arr)
+        raw = mp.RawArray('b', max(arr.nbytes, 1))
+        _as_array(raw, arr.shape, arr.dtype)[:] = arr
+        specs[name] = ('raw', raw, arr.shape, arr.dtype)
+
+    heavy = ['src_model', 'trg_feats', 'trg2src_counts']
+    aligner_attrs = {k:v for k, v in aligner.__dict__.items() if not k in heavy}
+    src_model_attrs = {k:v for k, v in aligner.src_model.__dict__.items() if not k in ['X', 'offsets', 'log_prob_z_cache', 'cached']}
+    logger.info('Sharded EM with {} workers and {} shards'.format(n_workers, len(self.shards)))
+    self.pool = mp.get_context('spawn').Pool(n_workers,
+                                             initializer=_init_worker,
+                                             initargs=(type(aligner), aligner_attrs, src_model_attrs, specs))
+
+  def update_counts(self):
+    P_ts = self.aligner.P_ts
+    means = self.aligner.src_model.means
+    results = self.pool.map(_compute_counts, [(ids, P_ts, means) for ids in self.shards])
+    C_ts = np.zeros((self.aligner.Kt, self.aligner.Ks))
+    log_probs = []
+    for C_ts_shard, log_probs_shard in results:
+      C_ts += C_ts_shard
+      log_probs.extend(log_probs_shard)
+    self.aligner.trg2src_counts[:] = C_ts
+    self.aligner.P_ts = self.aligner.translate_prob()
+    return np.mean(log_probs)
+
+  def update_components(self):
+    P_ts = self.aligner.P_ts
+    means = self.aligner.src_model.means
+    results = self.pool.map(_compute_component_stats, [(ids, P_ts, means) for ids in self.shards])
+    means_new = np.zeros(means.shape)
+    counts = np.zeros((self.aligner.Ks,))
+    for means_shard, counts_shard in results:
+      means_new += means_shard
+      counts += counts_shard
+    self.aligner.src_model.set_means(means_new / np.maximum(counts[:, np.newaxis], EPS))
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+def _as_array(raw, shape, dtype):
+  return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def memmap_spec(arr):
+  """
+  Returns ('memmap', file, byte offset, shape, dtype) of a C-contiguous view
+  of a memory-mapped file, to be mapped again by the workers, None for other arrays
+  """
+  if not isinstance(arr, np.memmap) or arr.filename is None or not arr.flags['C_CONTIGUOUS']:
+    return None
+  # The array mapping the file from its offset, of which arr may be a view
+  root = arr
+  while isinstance(root.base, np.ndarray):
+    root = root.base
+  if not isinstance(root, np.memmap):
+    return None
+  offset = root.offset + arr.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+  return ('memmap', arr.filename, offset, arr.shape, arr.dtype)
+
+def _attach(spec):
+  if spec[0] == 'memmap':
+    _, filename, offset, shape, dtype = spec
+    if int(np.prod(shape)) == 0:
+      return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+  _, raw, shape, dtype = spec
+  return _as_array(raw, shape, dtype)
+
+def _init_worker(cls, aligner_attrs, src_model_attrs, specs):
+  src_model = RegionVGMM.__new__(RegionVGMM)
+  src_model.__dict__.update(src_model_attrs)
+  src_model.X = _attach(specs['X'])
+  src_model.offsets = _attach(specs['src_offsets'])
+  src_model.init_cache()
+
+  aligner = cls.__new__(cls)
+  aligner.__dict__.update(aligner_attrs)
+  aligner.src_model = src_model
+  if 'trg_indices' in specs:
+    aligner.trg_feats = SparsePosteriorsArray(_attach(specs['trg_indices']), _attach(specs['trg_weights']), _attach(specs['trg_offsets']))
+  else:
+    aligner.trg_feats = RaggedArray(_attach(specs['trg_feats']), _attach(specs['trg_offsets']))
+  _worker['aligner'] = aligner
+
+def _set_means(src_model, means):
+  # Keep the posteriors cached by the E-step of the same iteration
+  if not np.array_equal(src_model.means, means):
+    src_model.set_means(means)
+
+def _compute_counts(args):
+  ex_ids, P_ts, means = args
+  aligner = _worker['aligner']
+  aligner.P_ts = P_ts
+  _set_means(aligner.src_model, means)
+  return aligner.compute_counts(ex_ids)
+
+def _compute_component_stats(args):
+  ex_ids, P_ts, means = args
+  aligner = _worker['aligner']
+  aligner.P_ts = P_ts
+  _set_means(aligner.src_model, means)
+  return aligner.compute_component_stats(ex_ids)
@@ -0,0 +1,64 @@
+import numpy as np
+from aligner_utils import is_discrete
+
+class StepwiseEM(object):
+  """
+  Stepwise (online) EM (Liang and Klein, 2009) for the mixture aligners. The
+  expected counts of each mini-batch are blended into running sufficient
+  statistics with the step size eta_k = (k + 2)^(-decay), and P_ts and the 
+  means are updated after every batch, so only the current batch has to be
+  kept in memory.
+
+  Parameters
+  ----------
+  aligner : ContinuousMixtureAligner or FullyContinuousMixtureAligner
+  decay : float
+      The decay rate of the step size, with 0.5 < decay <= 1 
+  """
+  def __init__(self, aligner, decay=0.7):
+    self.aligner = aligner
+    self.decay = decay
+    self.n_updates = 0
+    self.means_stats = np.zeros(aligner.src_model.means.shape)
+    self.counts_stats = np.zeros((aligner.Ks,))
+
+  def step_size(self):
+    return (self.n_updates + 2.) ** (-self.decay)
+
+  def update(self, source_features, target_features):
+    """
+    Parameters
+    ----------
+    source_features : list of T x D arrays of region features
+    target_features : list of target sentences, without NULL
+
+    Returns
+    -------
+    log_prob : average log likelihood of the batch before the update
+    """
+    aligner = self.aligner
+    src_model = aligner.src_model
+    if aligner.use_null:
+      target_features = [[aligner.Kt-1]+list(trg_feat) if is_discrete(trg_feat) else trg_feat for trg_feat in target_features]
+    eta = self.step_size()
+
+    src_sents = [np.exp(self.log_prob_z(src_feat, normalize=False)) for src_feat in source_features]
+    C_ts, log_probs = aligner.compute_counts_block(src_sents, target_features)
+    aligner.trg2src_counts = (1. - eta) * aligner.trg2src_counts + eta * C_ts
+    # Keep the translation probabilities of the target words not seen so far
+    seen = np.sum(aligner.trg2src_counts, axis=1) > 0
+    aligner.P_ts[seen] = aligner.translate_prob()[seen]
+
+    src_sents = [np.exp(self.log_prob_z(src_feat)) for src_feat in source_features]
+    means_new, counts = aligner.compute_component_stats_block(src_sents, target_features, source_features)
+    self.means_stats = (1. - eta) * self.means_stats + eta * means_new
+    self.counts_stats = (1. - eta) * self.counts_stats + eta * counts
+    seen = self.counts_stats > 0
+    src_model.means[seen] = self.means_stats[seen] / self.counts_stats[seen, np.newaxis]
+    src_model.invalidate_cache()
+    self.n_updates += 1
+    return np.mean(log_probs)
+
+  def log_prob_z(self, src_feat, normalize=True):
+    log_prob_z = self.aligner.src_model.log_prob_z_given_X(src_feat, normalize=normalize)
+    return log_prob_z.reshape(len(src_feat), self.aligner.Ks)
@@ -0,0 +1,168 @@
+import numpy as np
+import json
+import os
+import argparse
+
+# Alignment files hold one entry per example, a dict with, e.g., 'alignment',
+# 'image_concepts' and 'align_probs' (a T x L list of alignment probabilities).
+# The format is given by the extension:
+#   .json : a single JSON list of the entries (the original format)
+#   .jsonl : one JSON entry per line, with the probabilities at float16 precision
+#   .npz : ragged arrays, each field stored as the concatenation of the
+#          flattened values of the entries ('<field>'), their offsets
+#          ('<field>_offsets') and shapes ('<field>_shapes'), with the
+#          probabilities as float16
+# with files of any other extension read and written as .json
+ALIGNMENT_EXTS = ['.jsonl', '.npz', '.json']
+
+def alignment_format(path):
+  ext = os.path.splitext(path)[1]
+  return ext if ext in ALIGNMENT_EXTS else '.json'
+
+_float16_text = None
+
+def float16_text():
+  """Returns the shortest text of every float16 value, indexed by its bits"""
+  global _float16_text
+  if _float16_text is None:
+    _float16_text = np.asarray([str(v) for v in np.arange(2**16, dtype=np.uint16).view(np.float16)], dtype=object)
+  return _float16_text
+
+def float16_json(value):
+  """
+  Returns the JSON text of a float array with the shortest float16
+  representation of its values, formatted a row at a time. Raises a
+  ValueError for values that are not finite at float16 precision, which
+  JSON cannot represent
+  """
+  value = np.asarray(value, dtype=np.float16)
+  if not np.all(np.isfinite(value)):
+    raise ValueError('Cannot write non-finite values as JSON')
+  text = float16_text()[value.view(np.uint16).ravel()].reshape(value.shape)
+  while text.ndim > 0:
+    rows = text.reshape(int(np.prod(text.shape[:-1])), text.shape[-1]).tolist()
+    text = np.asarray(['[' + ','.join(row) + ']' for row in rows], dtype=object).reshape(text.shape[:-1])
+  return text.item()
+
+def is_float_field(value):
+  return np.asarray(value).dtype.kind == 'f'
+
+class AlignmentWriter(object):
+  """
+  Writes alignment entries one at a time to a .json, .jsonl or .npz file;
+  the .npz arrays are written on close()
+
+  Parameters
+  ----------
+  path : str
+  """
+  def __init__(self, path):
+    self.path = path
+    self.format = alignment_format(path)
+    self.n_entries = 0
+    if self.format == '.npz':
+      self.fields = {}
+    else:
+      self.f = open(path, 'w')
+      if self.format == '.json':
+        self.f.write('[')
+
+  def write(self, entry):
+    if self.format == '.npz':
+      for k, v in entry.items():
+        v = np.asarray(v)
+        v = v.astype(np.float16) if v.dtype.kind == 'f' else v.astype(np.int32)
+        self.fields.setdefault(k, []).append(v)
+    else:
+      items = []
+      for k in sorted(entry):
+        v = entry[k]
+        text = float16_json(v) if self.format == '.jsonl' and is_float_field(v) else json.dumps(np.asarray(v).tolist())
+        items.append('{}: {}'.format(json.dumps(k), text))
+      if self.format == '.json' and self.n_entries > 0:
+        self.f.write(',\n')
+      self.f.write('{' + ', '.join(items) + '}')
+      if self.format == '.jsonl':
+        self.f.write('\n')
+    self.n_entries += 1
+
+  def close(self):
+    if self.format == '.npz':
+      arrays = {}
+      for k, vs in self.fields.items():
+        if len(vs) != self.n_entries:
+          raise ValueError('Field {} is missing from some of the entries'.format(k))
+        arrays[k] = np.concatenate([v.ravel() for v in vs]) if len(vs) > 0 else np.zeros(0)
+        arrays[k+'_offsets'] = np.cumsum([0]+[v.size for v in vs]).astype(np.int64)
+        ndim = max([v.ndim for v in vs], default=0)
+        arrays[k+'_shapes'] = np.asarray([v.shape for v in vs], dtype=np.int64).reshape(len(vs), ndim)
+      np.savez(self.path, **arrays)
+    else:
+      if self.format == '.json':
+        self.f.write(']')
+      self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def write_alignments(path, entries):
+  with AlignmentWriter(path) as writer:
+    for entry in entries:
+      writer.write(entry)
+
+def read_alignments(path):
+  """
+  Yields the entries of an alignment file one at a time, with integer fields
+  as lists and probabilities as float arrays (lists for .json files)
+  """
+  fmt = alignment_format(path)
+  if fmt == '.json':
+    with open(path, 'r') as f:
+      for entry in json.load(f):
+        yield entry
+  elif fmt == '.jsonl':
+    with open(path, 'r') as f:
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+  else:
+    with np.load(path) as npz:
+      keys = [k for k in npz.files if not k.endswith('_offsets') and not k.endswith('_shapes')]
+      fields = {k:(npz[k], npz[k+'_offsets'], npz[k+'_shapes']) for k in keys}
+    n = len(fields[keys[0]][1]) - 1 if keys else 0
+    for i in range(n):
+      entry = {}
+      for k, (values, offsets, shapes) in fields.items():
+        v = values[offsets[i]:offsets[i+1]].reshape(shapes[i])
+        entry[k] = v.astype(np.float32) if v.dtype.kind == 'f' else v.tolist()
+      yield entry
+
+def count_alignments(path):
+  """Returns the number of entries of an alignment file, without loading a .npz file"""
+  fmt = alignment_format(path)
+  if fmt == '.npz':
+    with np.load(path) as npz:
+      offset_keys = [k for k in npz.files if k.endswith('_offsets')]
+      return len(npz[offset_keys[0]]) - 1 if offset_keys else 0
+  return sum(1 for _ in read_alignments(path))
+
+def find_alignment_file(prefix):
+  """Returns the first of prefix.jsonl, prefix.npz and prefix.json that exists, prefix.json if none"""
+  for ext in ALIGNMENT_EXTS:
+    if os.path.isfile(prefix + ext):
+      return prefix + ext
+  return prefix + '.json'
+
+def convert_alignments(in_file, out_file):
+  """Converts an alignment file to the format of the extension of out_file"""
+  write_alignments(out_file, read_alignments(in_file))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('IN_FILE', type=str, help='Alignment file (.json, .jsonl or .npz)')
+  parser.add_argument('OUT_FILE', type=str, help='Converted alignment file (.json, .jsonl or .npz)')
+  args = parser.parse_args()
+  convert_alignments(args.IN_FILE, args.OUT_FILE)
@@ -11,6 +11,7 @@ from copy import deepcopy
 import functools
 from sklearn.metrics import precision_recall_curve, average_precision_score 
 import pandas as pd
+from alignment_io import read_alignments, find_alignment_file, ALIGNMENT_EXTS
 
 PUNCT = [',', '\'', '\"', '/', '?', '>', '<', '#', '%', '&', '*', ':', ';', '!', '.']
 STOP = stopwords.words('english') + ['er', 'oh', 'ah', 'uh', 'um', 'ha']
@@ -727,9 +728,8 @@ def create_alignment_score_file(caption_file,
       assert iou <= 1 and iou >= 0
       return iou
          
-  with open(caption_file, 'r') as capt_f,\
-       open(pred_alignment_file, 'r') as align_f: # Find the alignments between pred boxes and gold boxes
-    alignments = json.load(align_f)
+  with open(caption_file, 'r') as capt_f: # Find the alignments between pred boxes and gold boxes
+    alignments = read_alignments(pred_alignment_file)
 
     if keep_id_file:
       with open(keep_id_file, 'r') as keep_f:
@@ -887,9 +887,8 @@ def filter_boxes(caption_file,
       assert iou <= 1 and iou >= 0
       return iou
          
-  with open(caption_file, 'r') as capt_f,\
-       open(pred_alignment_file, 'r') as align_f:
-    alignments = json.load(align_f)
+  with open(caption_file, 'r') as capt_f:
+    alignments = read_alignments(pred_alignment_file)
 
     if keep_id_file:
       with open(keep_id_file, 'r') as keep_f:
@@ -1055,9 +1054,8 @@ def filter_segment_boxes(caption_file,
       assert iou <= 1 and iou >= 0
       return iou
          
-  with open(caption_file, 'r') as capt_f,\
-       open(pred_alignment_file, 'r') as align_f:
-    alignments = json.load(align_f)
+  with open(caption_file, 'r') as capt_f:
+    alignments = read_alignments(pred_alignment_file)
 
     if keep_id_file:
       with open(keep_id_file, 'r') as keep_f:
@@ -1167,7 +1165,7 @@ if __name__ == '__main__':
   if args.task == 0:
     alignment_files = []
     for fn in os.listdir(exp_dir):
-      if 'alignment' in fn and 'json' in fn and not 'train' in fn:
+      if 'alignment' in fn and os.path.splitext(fn)[1] in ALIGNMENT_EXTS and not 'train' in fn:
         alignment_files.append('{}/{}'.format(exp_dir, fn))
         
     # if not os.path.isfile(pred_file):
@@ -1218,7 +1216,7 @@ if __name__ == '__main__':
     caption_file = '{}/val2014/mscoco_val_text_captions.txt'.format(data_dir)
     pred_file = os.path.join(exp_dir, 'predicted_annotated_boxes.txt')
     gold_file = os.path.join(exp_dir, 'gold_annotated_boxes.txt')
-    pred_alignment_file = os.path.join(exp_dir, 'alignment.json')
+    pred_alignment_file = find_alignment_file(os.path.join(exp_dir, 'alignment'))
     _ = filter_boxes(caption_file, 
                      pred_alignment_file, 
                      unfiltered_pred_box_file,
@@ -1238,7 +1236,7 @@ if __name__ == '__main__':
     caption_file = '{}/val2014/mscoco_val_text_captions.txt'.format(data_dir)
     pred_file = os.path.join(exp_dir, 'binary_alignment_scores.txt')
     gold_file = os.path.join(exp_dir, 'binary_alignment_labels.txt')
-    pred_alignment_file = os.path.join(exp_dir, 'alignment.json')
+    pred_alignment_file = find_alignment_file(os.path.join(exp_dir, 'alignment'))
     create_alignment_label_file(caption_file,
                                 gold_box_file,
                                 out_file=gold_file,
@@ -0,0 +1,66 @@
+import numpy as np
+
+def matching_ranks(scores, axis=1):
+  """
+  Parameters
+  ----------
+  scores : n_src x n_trg array of retrieval scores, with the i-th source
+           matching the i-th target
+  axis : int
+      1 to rank the targets of each source (the rows), 0 to rank the
+      sources of each target (the columns)
+
+  Returns
+  -------
+  ranks : length min(n_src, n_trg) int array of the 0-based ranks of the
+          matching items, with ties ranked by index
+  """
+  scores = np.asarray(scores)
+  if axis == 0:
+    scores = scores.T
+  n = min(scores.shape)
+  gold = np.diagonal(scores)[:n, np.newaxis]
+  n_above = np.sum(scores[:n] > gold, axis=1)
+  n_ties = np.sum(np.tril(scores[:n, :n] == gold, k=-1), axis=1)
+  return n_above + n_ties
+
+def kbest_ranks(kbest, axis=1):
+  """
+  Parameters
+  ----------
+  kbest : n x k (axis=1) or k x n (axis=0) array of the indices of the k
+          best candidates of each query, best first
+
+  Returns
+  -------
+  ranks : length n int array of the 0-based ranks of the matching items,
+          k if not among the k best
+  """
+  kbest = np.asarray(kbest)
+  if axis == 0:
+    kbest = kbest.T
+  hits = kbest == np.arange(kbest.shape[0])[:, np.newaxis]
+  return np.where(np.any(hits, axis=1), np.argmax(hits, axis=1), kbest.shape[1])
+
+def rank_metrics(ranks, ks=[1, 5, 10], kbest=None):
+  """
+  Parameters
+  ----------
+  ranks : int array of 0-based ranks, from matching_ranks() or kbest_ranks()
+  kbest : int
+      The number of candidates kept, if the ranks come from kbest_ranks(); the
+      rank statistics are then lower bounds and the mAP is truncated at kbest
+
+  Returns
+  -------
+  metrics : dict of the recall@k ('R@k'), the median and mean 1-based ranks
+            and the mAP, which is the mean reciprocal rank for a single
+            matching item per query
+  """
+  ranks = np.asarray(ranks)
+  metrics = {'R@{}'.format(k):np.mean(ranks < k) for k in ks if kbest is None or k <= kbest}
+  metrics['median_rank'] = np.median(ranks + 1)
+  metrics['mean_rank'] = np.mean(ranks + 1)
+  found = ranks < kbest if kbest is not None else np.ones(len(ranks), dtype=bool)
+  metrics['mAP'] = np.mean(np.where(found, 1. / (ranks + 1), 0.))
+  return metrics